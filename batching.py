@@ -0,0 +1,168 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Groups preprocessed images of different sizes into shape buckets so that
+# each batch can be padded into a single contiguous tensor.
+
+from collections import OrderedDict
+import math
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+class Sample(NamedTuple):
+    key: Any            # identifies the sample when the results come back
+    data: np.ndarray    # preprocessed image in CHW layout
+
+class Batch(NamedTuple):
+    keys: List[Any]
+    data: np.ndarray    # NCHW, padded to a common height and width
+    sizes: List[Tuple[int, int]] # (height, width) of each sample before padding
+
+def padded_shape(height: int, width: int, multiple: int) -> Tuple[int, int]:
+    """Round 'height' and 'width' up to the next multiple of 'multiple'"""
+    if multiple <= 1:
+        return (height, width)
+    return (math.ceil(height / multiple) * multiple, math.ceil(width / multiple) * multiple)
+
+class BufferPool:
+    """Keeps arrays for the most recently used 'max_buffers' shapes, so that
+    batches of a shape seen before are assembled without allocating.
+
+    An array handed out by 'get' is handed out again for the next request
+    of the same shape, so it must not be used any longer than that.
+    """
+    def __init__(self, max_buffers: int = 8):
+        self.max_buffers = max(max_buffers, 1)
+        self._buffers: 'OrderedDict[Tuple, np.ndarray]' = OrderedDict()
+
+    def get(self, shape: Tuple[int, ...], dtype=np.float32) -> np.ndarray:
+        key = (tuple(shape), np.dtype(dtype))
+        buf = self._buffers.pop(key, None)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+        self._buffers[key] = buf
+        while len(self._buffers) > self.max_buffers:
+            self._buffers.popitem(last=False)
+        return buf
+
+    def __len__(self):
+        return len(self._buffers)
+
+def stack(samples: List[Sample], shape: Tuple[int, int], pool: Optional[BufferPool] = None) -> np.ndarray:
+    """Copy 'samples' into a zero padded NCHW array with spatial 'shape',
+    taken from 'pool' if set"""
+    channels = samples[0].data.shape[0]
+    full_shape = (len(samples), channels) + tuple(shape)
+    dtype = samples[0].data.dtype
+    if pool is None:
+        data = np.zeros(full_shape, dtype=dtype)
+        for i, s in enumerate(samples):
+            _, h, w = s.data.shape
+            data[i, :, :h, :w] = s.data
+        return data
+    data = pool.get(full_shape, dtype)
+    for i, s in enumerate(samples):
+        _, h, w = s.data.shape
+        data[i, :, :h, :w] = s.data
+        # only the padding needs clearing
+        data[i, :, h:, :] = 0
+        data[i, :, :h, w:] = 0
+    return data
+
+def crop(results: np.ndarray, sizes: List[Tuple[int, int]]) -> Union[np.ndarray, List[np.ndarray]]:
+    """Remove the padding added by 'stack' from a batch of results.
+    Works for both label maps (NHW) and logits (NCHW). If no sample was
+    padded, 'results' is returned as is, so that it can still be processed
+    as one array (see 'class_histograms')."""
+    if len(sizes) == len(results) and all(tuple(s) == results.shape[-2:] for s in sizes):
+        return results
+    return [r[..., :h, :w] for r, (h, w) in zip(results, sizes)]
+
+def class_histograms(results, num_classes: int) -> np.ndarray:
+    """Return the number of pixels per class for a batch of label maps
+    as an array of shape (len(results), num_classes).
+
+    If 'results' is a single (N, H, W) array, all label maps are counted
+    with one 'bincount' by offsetting the labels of each image.
+    """
+    if isinstance(results, np.ndarray) and results.ndim == 3 and results.max(initial=0) < num_classes:
+        n = results.shape[0]
+        offsets = np.arange(n, dtype=np.int64).reshape(n, 1, 1) * num_classes
+        counts = np.bincount((results + offsets).ravel(), minlength=n * num_classes)
+        return counts.reshape(n, num_classes)
+    hists = np.zeros((len(results), num_classes), dtype=np.int64)
+    for i, r in enumerate(results):
+        # labels outside the known classes (e.g. 'ignore') are not counted
+        counts = np.bincount(r.ravel(), minlength=num_classes)
+        hists[i] = counts[:num_classes]
+    return hists
+
+class ShapeBucketer:
+    """Collects samples into buckets of equal (padded) shape and releases a
+    bucket as a batch once it holds 'batch_size' samples.
+
+    To bound memory, the fullest bucket is released early whenever more than
+    'max_pending' samples are waiting across all buckets.
+
+    Samples are only padded when batched with others: with a 'batch_size'
+    of 1 each one keeps its own shape, as padding would change the results
+    near the bottom and right edges for nothing.
+
+    If 'pool' is set, batches are assembled in reused arrays (see 'BufferPool').
+    """
+    def __init__(self, batch_size: int, pad_multiple: int, max_pending: Optional[int] = None,
+                 pool: Optional[BufferPool] = None):
+        self.batch_size = max(batch_size, 1)
+        self.pad_multiple = pad_multiple if self.batch_size > 1 else 1
+        self.pool = pool
+        self.max_pending = max_pending if max_pending else 4 * self.batch_size
+        self.buckets: Dict[Tuple[int, int], List[Sample]] = {}
+        self.pending = 0
+
+    def add(self, sample: Sample) -> Optional[Batch]:
+        _, h, w = sample.data.shape
+        shape = padded_shape(h, w, self.pad_multiple)
+        bucket = self.buckets.setdefault(shape, [])
+        bucket.append(sample)
+        self.pending += 1
+        if len(bucket) >= self.batch_size:
+            return self._release(shape)
+        if self.pending > self.max_pending:
+            fullest = max(self.buckets, key=lambda k: len(self.buckets[k]))
+            return self._release(fullest)
+        return None
+
+    def flush(self) -> Iterator[Batch]:
+        for shape in list(self.buckets):
+            yield self._release(shape)
+
+    def _release(self, shape: Tuple[int, int]) -> Batch:
+        samples = self.buckets.pop(shape)
+        self.pending -= len(samples)
+        return Batch(
+            keys=[s.key for s in samples],
+            data=stack(samples, shape, self.pool),
+            sizes=[s.data.shape[1:] for s in samples])
+
+def bucket_batches(samples: Iterable[Sample], batch_size: int, pad_multiple: int,
+                   pool: Optional[BufferPool] = None) -> Iterator[Batch]:
+    """Turn a stream of samples into a stream of padded batches. With a
+    'pool', a batch's data is only valid until the next batch is requested."""
+    bucketer = ShapeBucketer(batch_size, pad_multiple, pool=pool)
+    for s in samples:
+        batch = bucketer.add(s)
+        if batch is not None:
+            yield batch
+    yield from bucketer.flush()
@@ -0,0 +1,345 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standalone benchmark which runs synthetic images through the same pipeline
+# as the service ('Predictor.run' with its preprocess, batching, inference and
+# delivery stages), without any IVCAP services, and reports per stage
+# latencies, throughput and peak memory as JSON. All parameters of
+# 'infer_service.SERVICE' which affect performance are available as options,
+# so that configurations can be compared. For example:
+#
+#   python benchmark.py --model export_model/model.tgz --sizes 4000x3000 1920x1080 --images 20 \
+#       --batch-size 4 --pad-multiple 64 --encode-processes 2 --deliver-latency 50
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+import io
+import json
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from ivcap_sdk_service import Type
+
+import infer_service
+import predictor
+from predictor import DeployConfig, Predictor, auto_tune, decode_image, use_auto_tune
+from pipeline import imap_bounded, prefetch
+from batching import class_histograms
+from model_cache import extract_model
+from sharding import ShardedPredictor, set_logger as set_sharding_logger
+from encoders import Encoded, PngEncoderPool, compile_palette, encode_mask, palette_image
+from delivery import Deliverer, set_logger as set_delivery_logger
+
+STAGES = ['decode', 'transform', 'copy_from_cpu', 'run', 'copy_to_cpu', 'argmax', 'cover',
+          'colourise', 'encode', 'deliver']
+
+# service parameters which are about the order rather than its performance
+NOT_BENCHMARKED = ['model', 'extra-models', 'images', 'model-cache-dir', 'model-cache-size',
+                   'result-cache-dir', 'result-cache-size', 'benchmark', 'model-name']
+
+def add_service_options(parser: argparse.ArgumentParser):
+    """Add the parameters of 'infer_service.SERVICE' as options, with the same defaults"""
+    group = parser.add_argument_group('service parameters')
+    for p in infer_service.SERVICE.parameters:
+        if p.name in NOT_BENCHMARKED:
+            continue
+        flag = f"--{p.name}"
+        if p.type == Type.BOOL:
+            group.add_argument(flag, action='store_true', help=p.description)
+        elif p.type == Type.OPTION:
+            group.add_argument(flag, choices=[o.value for o in p.options], default=p.default, help=p.description)
+        else:
+            # string defaults are converted by argparse
+            conv = {Type.INT: int, Type.FLOAT: float}.get(p.type, str)
+            group.add_argument(flag, type=conv, default=p.default, help=p.description)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark a segmentation model on synthetic images.')
+    parser.add_argument('--model', required=True, help='Model archive as created by export_model/export.py')
+    parser.add_argument('--sizes', nargs='+', default=['1920x1080'], help='Sizes (WxH) of the synthetic images')
+    parser.add_argument('--images', type=int, default=10, help='Number of images per size')
+    parser.add_argument('--warmup', type=int, default=2, help='Number of images to run before measuring')
+    parser.add_argument('--format', default='JPEG', help='File format of the synthetic images')
+    parser.add_argument('--output', default=None, help='File to write the JSON report to (default: stdout)')
+    parser.add_argument('--out-dir', default=None, help='Directory to "deliver" results to (default: discard)')
+    parser.add_argument('--deliver-latency', type=float, default=0,
+                        help='Simulated round trip time (ms) of every result upload')
+    add_service_options(parser)
+    return parser.parse_args()
+
+class StageTimer:
+    """Collects the duration of every execution of a named stage.
+    Stages run concurrently on the pipeline's threads."""
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {s: [] for s in STAGES}
+        self.enabled = True
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        yield
+        if self.enabled:
+            with self._lock:
+                self.samples[stage].append(time.perf_counter() - start)
+
+    def timed(self, stage: str, fn):
+        """Return 'fn' wrapped to be timed as 'stage'"""
+        def wrapper(*args, **kwargs):
+            with self(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            ms = np.array(samples) * 1000
+            report[stage] = {
+                'count': len(samples),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+                'p99_ms': float(np.percentile(ms, 99)),
+                'total_ms': float(ms.sum()),
+            }
+        return report
+
+class TimedPaddlePredictor:
+    """Wraps a paddle predictor to time 'run' and copying the output"""
+    def __init__(self, paddle_predictor, timer: StageTimer):
+        self._predictor = paddle_predictor
+        self._timer = timer
+        self.run = timer.timed('run', paddle_predictor.run)
+
+    def get_output_handle(self, name):
+        return TimedOutputHandle(self._predictor.get_output_handle(name), self._timer)
+
+    def __getattr__(self, name):
+        return getattr(self._predictor, name)
+
+class TimedOutputHandle:
+    def __init__(self, handle, timer: StageTimer):
+        self._handle = handle
+        self.copy_to_cpu = timer.timed('copy_to_cpu', handle.copy_to_cpu)
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+class SyntheticImage:
+    """Stands in for an IVCAP image artifact"""
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def as_local_file(self) -> str:
+        return self.path
+
+def create_images(dir: str, sizes: List[str], count: int, format: str) -> List[SyntheticImage]:
+    """Create 'count' images per entry in 'sizes' with smooth gradients plus noise,
+    which compresses roughly like a real photo"""
+    rng = np.random.default_rng(0)
+    images = []
+    for size in sizes:
+        w, h = [int(v) for v in size.lower().split('x')]
+        y, x = np.mgrid[0:h, 0:w]
+        base = np.stack([x * 255 // max(w, 1), y * 255 // max(h, 1), (x + y) * 255 // max(w + h, 1)], axis=-1)
+        for i in range(count):
+            noise = rng.integers(0, 32, (h, w, 3))
+            img = Image.fromarray(((base + noise) % 256).astype(np.uint8))
+            path = os.path.join(dir, f"synthetic-{w}x{h}-{i}.{format.lower()}")
+            img.save(path, format)
+            images.append(SyntheticImage(path))
+    return images
+
+def get_colormap(meta) -> List[int]:
+    cm = []
+    for cl in meta.get("classes", []):
+        cm.extend(cl["def_color"])
+    return cm or None
+
+class BenchIO:
+    """Stands in for the service's 'IOManager': fetches and decodes the
+    images the same way, and encodes and delivers the results like
+    'ModelOutput.save_imgs' does, minus metadata and result cache."""
+    def __init__(self, args, cfg: DeployConfig, images: List[SyntheticImage], timer: StageTimer,
+                 deliverer: Deliverer, png_pool=None):
+        self.args = args
+        self.images = images
+        self.timer = timer
+        self.deliverer = deliverer
+        self.png_pool = png_pool
+        self.classes = cfg.meta.get("classes") or []
+        self.palette = compile_palette(get_colormap(cfg.meta))
+        self.max_img_size = -1 if args.tile_size else args.max_img_size
+        self.delivered = 0
+
+    def __iter__(self):
+        args = self.args
+        fetched = imap_bounded(self._fetch_image, enumerate(self.images),
+                               args.download_workers, 2 * args.download_workers)
+        return prefetch(fetched, args.prefetch_depth)
+
+    def _fetch_image(self, item):
+        key, img = item
+        with self.timer('decode'):
+            return key, decode_image(img.as_local_file(), self.max_img_size)
+
+    def save_imgs(self, results, keys):
+        with self.timer('cover'):
+            class_histograms(results, len(self.classes) or 256)
+        encoded = [self._encode(r) for r in results]
+        for key, enc in zip(keys, encoded):
+            if isinstance(enc, Future):
+                # encoded in another process, only the wait shows up here
+                with self.timer('encode'):
+                    enc = enc.result()
+            basename, _ = os.path.splitext(self.images[key].name)
+            self.deliverer.submit(f"{basename}{enc.suffix}", enc.data, enc.mime_type)
+            self.delivered += 1
+
+    def _encode(self, label: np.ndarray):
+        args = self.args
+        if self.png_pool:
+            return self.png_pool.submit(label, self.palette, args.png_compress_level)
+        if args.output_format != 'pseudo-png':
+            with self.timer('encode'):
+                return encode_mask(label, args.output_format, self.palette, self.classes)
+        # same as 'encode_png', with colouring and compression timed separately
+        with self.timer('colourise'):
+            img = palette_image(label, self.palette)
+        with self.timer('encode'):
+            buf = io.BytesIO()
+            img.save(buf, format='png', compress_level=args.png_compress_level)
+        return Encoded('.pseudo.png', 'image/png', buf.getvalue())
+
+def local_deliver(timer: StageTimer, out_dir: str, latency: float):
+    """Return a 'deliver_data' stand-in which writes to 'out_dir' (or
+    discards the data), after waiting 'latency' seconds"""
+    def deliver(name, write, mime_type, metadata=None):
+        with timer('deliver'):
+            if latency > 0:
+                time.sleep(latency)
+            if out_dir:
+                with open(os.path.join(out_dir, name), 'wb') as f:
+                    write(f)
+            else:
+                write(io.BytesIO())
+    return deliver
+
+def create_predictor(args, cfg: DeployConfig, model_dir: str, images: List[SyntheticImage], tmp_dir: str,
+                     timer: StageTimer):
+    if args.device == 'cpu' and args.cpu_workers > 1:
+        # the stages inside the worker processes can't be timed from here
+        return ShardedPredictor(args, model_dir, args.cpu_workers)
+    shape_file = None
+    if use_auto_tune(args):
+        shape_file = os.path.join(tmp_dir, 'auto_tune.pbtxt')
+        max_size = -1 if args.tile_size else args.max_img_size
+        auto_tune(args, cfg, [decode_image(img.path, max_size) for img in images[:args.auto_tune_images]],
+                  shape_file)
+        if not os.path.exists(shape_file):
+            shape_file = None
+    p = Predictor(args, cfg, shape_file)
+    p._preprocess = timer.timed('transform', p._preprocess)
+    p._set_input = timer.timed('copy_from_cpu', p._set_input)
+    p._postprocess = timer.timed('argmax', p._postprocess)
+    p.predictor = TimedPaddlePredictor(p.predictor, timer)
+    return p
+
+def run(args, timer: StageTimer, model_dir: str, images: List[SyntheticImage], tmp_dir: str) -> Tuple[int, float]:
+    """Run the warm up images and then all 'images' through the pipeline and
+    return the number of images measured and how long that took (secs)"""
+    cfg = DeployConfig(os.path.join(model_dir, 'deploy.yaml'))
+    p = create_predictor(args, cfg, model_dir, images, tmp_dir, timer)
+    png_pool = None
+    if args.encode_processes and args.output_format == 'pseudo-png':
+        png_pool = PngEncoderPool(args.encode_processes)
+    deliver = local_deliver(timer, args.out_dir, args.deliver_latency / 1000)
+    try:
+        warmup = images[:args.warmup] if isinstance(p, Predictor) else []
+        for imgs, measure in [(warmup, False), (images, True)]:
+            if not imgs:
+                continue
+            timer.enabled = measure
+            start = time.perf_counter()
+            deliverer = Deliverer(deliver, args.deliver_in_flight, args.deliver_retries)
+            bench_io = BenchIO(args, cfg, imgs, timer, deliverer, png_pool)
+            try:
+                p.run(bench_io)
+            finally:
+                deliverer.close()
+        return bench_io.delivered, time.perf_counter() - start
+    finally:
+        if png_pool:
+            png_pool.close()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("benchmark")
+    predictor.set_logger(logger)
+    set_sharding_logger(logger)
+    set_delivery_logger(logger)
+
+    # fill in the remaining settings 'Predictor' expects from the service
+    settings = dict(vars(args))
+    settings.update(benchmark=False, model_name=None, extra_models=None)
+    ST = namedtuple('ServiceArgs', settings.keys())
+    pargs = ST(**settings)
+
+    timer = StageTimer()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = os.path.join(tmp_dir, 'model')
+        extract_model(args.model, model_dir)
+        images = create_images(tmp_dir, args.sizes, args.images, args.format)
+
+        measured, elapsed = run(pargs, timer, model_dir, images, tmp_dir)
+
+    stages = timer.report()
+    report = {
+        'model': args.model,
+        'sizes': args.sizes,
+        'settings': {k: v for k, v in settings.items() if k not in ('model', 'sizes', 'output', 'extra_models')},
+        'images': measured,
+        'stages': stages,
+        'throughput': {
+            # the stages overlap, so this is less than the sum of the stage latencies
+            'images_per_sec': measured / elapsed if elapsed > 0 else None,
+            'wall_secs': elapsed,
+        },
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        # shard and encoder processes
+        'peak_child_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
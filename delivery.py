@@ -0,0 +1,116 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Asynchronous delivery of result artifacts, so that uploads overlap with
+# inference instead of adding their round trip time to every image.
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+logger = None # set when called by SDK
+
+def set_logger(l: logging):
+    global logger
+    logger = l
+
+DeliverF = Callable[..., Any] # same signature as 'ivcap_sdk_service.deliver_data'
+
+class Deliverer:
+    """Uploads artifacts on a pool of threads.
+
+    At most 'max_in_flight' uploads are outstanding at any time, 'submit'
+    blocks until a slot frees up. Failed uploads are retried up to 'retries'
+    times with exponential backoff (plus jitter) starting at 'backoff'
+    seconds. 'flush' waits for all outstanding uploads and re-raises the
+    first error, if any.
+
+    Args:
+        deliver (DeliverF): Function doing the actual upload, e.g. 'deliver_data'
+        max_in_flight (int): Max number of concurrent uploads
+        retries (int): Number of times a failed upload is retried
+        backoff (float): Delay (secs) before the first retry
+    """
+    def __init__(self, deliver: DeliverF, max_in_flight: int = 8, retries: int = 3, backoff: float = 0.5):
+        self.deliver = deliver
+        self.retries = max(retries, 0)
+        self.backoff = backoff
+        max_in_flight = max(max_in_flight, 1)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="deliver")
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._pending: List[Future] = []
+        self._errors: List[BaseException] = []
+
+    def submit(self, name: str, data: bytes, mime_type: Any, metadata: Optional[Any] = None) -> Future:
+        """Queue 'data' for upload as artifact 'name'"""
+        self._raise_error()
+        self._slots.acquire()
+        try:
+            f = self._executor.submit(self._deliver, name, data, mime_type, metadata)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.append(f)
+        f.add_done_callback(self._done)
+        return f
+
+    def _deliver(self, name, data, mime_type, metadata):
+        attempt = 0
+        while True:
+            try:
+                return self.deliver(name, lambda f: f.write(data), mime_type, metadata=metadata)
+            except Exception as err:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                attempt += 1
+                logger.warning(f"Delivering '{name}' failed ({err}) - retry {attempt}/{self.retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _done(self, f: Future):
+        self._slots.release()
+        with self._lock:
+            self._pending.remove(f)
+            if not f.cancelled() and f.exception() is not None:
+                self._errors.append(f.exception())
+
+    def _raise_error(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def flush(self):
+        """Wait until all queued uploads are done"""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            for f in pending:
+                try:
+                    f.result()
+                except Exception:
+                    pass # reported below
+        self._raise_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,141 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Encoders turning a label map into the bytes of one of the supported output
+# formats. The pseudo colour PNG is the most useful one to look at, the others
+# are much cheaper to produce and transfer when only the class IDs matter.
+
+from concurrent.futures import Future, ProcessPoolExecutor
+import io
+import json
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Any, List, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+class Encoded(NamedTuple):
+    suffix: str     # appended to the image's base name
+    mime_type: str
+    data: bytes
+
+def compile_palette(colormap: Optional[List[int]]) -> bytes:
+    """Turn a flat [r, g, b, r, g, b, ...] list of class colours into a PNG
+    palette, to be done once per model. Without colours, paddleseg's
+    default colour map is used."""
+    if not colormap:
+        from paddleseg.utils.visualize import get_color_map_list
+        colormap = get_color_map_list(256)
+    return np.asarray(colormap, dtype=np.uint8).tobytes()
+
+def palette_image(label: np.ndarray, palette: bytes) -> Image.Image:
+    """Label map as 'P' mode image, same as paddleseg's 'get_pseudo_color_map'"""
+    img = Image.fromarray(label.astype(np.uint8, copy=False), mode='P')
+    img.putpalette(palette)
+    return img
+
+def encode_png(label: np.ndarray, palette: bytes, compress_level: int) -> Encoded:
+    """8-bit palette PNG, with the class colours as palette"""
+    img = palette_image(label, palette)
+    buf = io.BytesIO()
+    img.save(buf, format='png', compress_level=compress_level)
+    return Encoded('.pseudo.png', 'image/png', buf.getvalue())
+
+def rle_counts(mask: np.ndarray) -> List[int]:
+    """COCO style (uncompressed) run lengths of a flattened binary mask,
+    always starting with the length of the first run of 0s"""
+    changes = np.flatnonzero(mask[1:] != mask[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [mask.size]))
+    counts = np.diff(bounds)
+    if mask.size and mask[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+def encode_rle(label: np.ndarray, classes: Optional[List[Any]]) -> Encoded:
+    """JSON with one COCO RLE (column major, uncompressed) per class present"""
+    h, w = label.shape
+    flat = label.ravel(order='F')
+    masks = []
+    for c in np.unique(flat):
+        m = {'label': int(c), 'size': [h, w], 'counts': rle_counts(flat == c)}
+        if classes and c < len(classes):
+            m['id'] = classes[c].get('id')
+        masks.append(m)
+    data = json.dumps({'size': [h, w], 'masks': masks}).encode()
+    return Encoded('.mask.rle.json', 'application/json', data)
+
+def encode_npy(label: np.ndarray, compress: bool) -> Encoded:
+    """Raw uint8 label map in numpy's '.npy' format, optionally zstd compressed"""
+    buf = io.BytesIO()
+    np.save(buf, label.astype(np.uint8, copy=False))
+    if not compress:
+        return Encoded('.mask.npy', 'application/x-npy', buf.getvalue())
+    import zstandard # optional dependency
+    data = zstandard.ZstdCompressor(level=3).compress(buf.getvalue())
+    return Encoded('.mask.npy.zst', 'application/zstd', data)
+
+OUTPUT_FORMATS = ['pseudo-png', 'rle-json', 'npy', 'npy-zstd']
+
+def encode_mask(label: np.ndarray, format: str, palette: Optional[bytes] = None,
+                classes: Optional[List[Any]] = None, compress_level: int = 6) -> Encoded:
+    """Encode 'label' in 'format' (one of OUTPUT_FORMATS). 'palette' is
+    the result of 'compile_palette'"""
+    if format == 'pseudo-png':
+        return encode_png(label, palette or compile_palette(None), compress_level)
+    if format == 'rle-json':
+        return encode_rle(label, classes)
+    if format == 'npy':
+        return encode_npy(label, False)
+    if format == 'npy-zstd':
+        return encode_npy(label, True)
+    raise ValueError(f"Unsupported output format '{format}'")
+
+def _encode_png_shared(name: str, shape, palette: bytes, compress_level: int) -> Encoded:
+    # spawned workers share the parent's resource tracker, so attaching
+    # doesn't register the block a second time - the parent unlinks it
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return encode_png(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf), palette, compress_level)
+    finally:
+        shm.close()
+
+def _release(shm: shared_memory.SharedMemory):
+    shm.close()
+    shm.unlink()
+
+class PngEncoderPool:
+    """Encodes pseudo colour PNGs in 'workers' processes, so that encoding
+    scales across cores instead of competing for the GIL with inference.
+
+    Label maps are handed over in shared memory blocks, which costs one copy
+    instead of pickling them, and are released once the PNG is returned.
+    """
+    def __init__(self, workers: int):
+        # 'spawn', as forking a process running paddle threads isn't safe
+        self._executor = ProcessPoolExecutor(max_workers=max(workers, 1), mp_context=mp.get_context("spawn"))
+
+    def submit(self, label: np.ndarray, palette: bytes, compress_level: int = 6) -> 'Future[Encoded]':
+        shm = shared_memory.SharedMemory(create=True, size=max(label.size, 1))
+        try:
+            np.ndarray(label.shape, dtype=np.uint8, buffer=shm.buf)[...] = label
+            f = self._executor.submit(_encode_png_shared, shm.name, label.shape, palette, compress_level)
+        except BaseException:
+            _release(shm)
+            raise
+        f.add_done_callback(lambda _: _release(shm))
+        return f
+
+    def close(self):
+        self._executor.shutdown(wait=True)
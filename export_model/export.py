@@ -13,17 +13,21 @@
 # limitations under the License.
 
 import argparse
+import glob
 import os
 from pathlib import Path
 import json
 
+import numpy as np
 import paddle
 import yaml
 import tempfile
 import tarfile
+import shutil
 
-from paddleseg.cvlibs import Config
+from paddleseg.cvlibs import Config, manager
 from paddleseg.utils import logger
+import paddleseg.transforms as T
 
 
 def parse_args():
@@ -71,15 +75,59 @@ def parse_args():
         help="Export the model with fixed input shape, such as 1 3 1024 1024.",
         type=int,
         default=None)
+    parser.add_argument(
+        "--shape-profile",
+        dest='shape_profiles',
+        nargs=3,
+        action='append',
+        metavar=('MIN', 'OPT', 'MAX'),
+        help="Range of input shapes (NxCxHxW) the model is optimised for, such as "
+        "1x3x256x256 4x3x512x512 4x3x1024x1024. Can be given more than once.",
+        default=None)
+    parser.add_argument(
+        '--shape-range-info',
+        dest='shape_range_info',
+        help="Auto tuned shape file (as kept in the infer service's --shape-cache-dir) to bundle with the model",
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--quantize',
+        dest='quantize',
+        help='Quantize the model to int8 (post training quantization) using the images in --calib-images',
+        action='store_true')
+    parser.add_argument(
+        '--calib-images',
+        dest='calib_images',
+        help='Directory of sample images to calibrate the int8 model with',
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--calib-num',
+        dest='calib_num',
+        help='Max number of images used for calibration',
+        type=int,
+        default=32)
+    parser.add_argument(
+        '--calib-algo',
+        dest='calib_algo',
+        help='Algorithm used to calculate the quantization scales',
+        choices=['KL', 'hist', 'avg', 'mse', 'abs_max'],
+        default='hist')
+    parser.add_argument(
+        '--packed',
+        dest='packed',
+        help='Save the model as an uncompressed, page aligned tar which the infer service '
+        'extracts without decompressing it (use a .tar --save-path)',
+        action='store_true')
 
     return parser.parse_args()
 
 
 class SavedSegmentationNet(paddle.nn.Layer):
-    def __init__(self, net, without_argmax=False, with_softmax=False):
+    def __init__(self, net, without_argmax=False, with_softmax=False, label_dtype='int32'):
         super().__init__()
         self.net = net
-        self.post_processer = PostPorcesser(without_argmax, with_softmax)
+        self.post_processer = PostPorcesser(without_argmax, with_softmax, label_dtype)
 
     def forward(self, x):
         outs = self.net(x)
@@ -88,10 +136,11 @@ class SavedSegmentationNet(paddle.nn.Layer):
 
 
 class PostPorcesser(paddle.nn.Layer):
-    def __init__(self, without_argmax, with_softmax):
+    def __init__(self, without_argmax, with_softmax, label_dtype='int32'):
         super().__init__()
         self.without_argmax = without_argmax
         self.with_softmax = with_softmax
+        self.label_dtype = label_dtype
 
     def forward(self, outs):
         new_outs = []
@@ -99,10 +148,23 @@ class PostPorcesser(paddle.nn.Layer):
             if self.with_softmax:
                 out = paddle.nn.functional.softmax(out, axis=1)
             if not self.without_argmax:
-                out = paddle.argmax(out, axis=1)
+                out = paddle.argmax(out, axis=1, dtype='int32')
+                if self.label_dtype != 'int32':
+                    # 4x less to copy out of the predictor
+                    out = paddle.cast(out, self.label_dtype)
             new_outs.append(out)
         return new_outs
 
+def label_dtype(net):
+    """Smallest dtype which holds all class IDs of 'net'"""
+    return 'uint8' if getattr(net, 'num_classes', 256) <= 256 else 'int32'
+
+def output_kind(args):
+    """What the exported model returns, recorded in meta.json"""
+    if not args.without_argmax:
+        return "label"
+    return "probabilities" if args.with_softmax else "logits"
+
 def load_net(args, shape):
     cfg = Config(args.cfg)
     net = cfg.model
@@ -114,7 +176,7 @@ def load_net(args, shape):
 
     if not args.without_argmax or args.with_softmax:
         new_net = SavedSegmentationNet(net, args.without_argmax,
-                                       args.with_softmax)
+                                       args.with_softmax, label_dtype(net))
     else:
         new_net = net
 
@@ -124,9 +186,116 @@ def load_net(args, shape):
         input_spec=[paddle.static.InputSpec(
             shape=shape, dtype='float32')])
     return [new_net, cfg]
+
+# what the infer service assumed before profiles were recorded
+DEFAULT_SHAPE_PROFILE = {
+    "min": [1, 3, 100, 100],
+    "opt": [1, 3, 512, 1024],
+    "max": [1, 3, 2000, 3000],
+}
+
+def parse_shape(s):
+    shape = [int(v) for v in s.lower().split('x')]
+    if len(shape) != 4:
+        raise ValueError(f"Expected a shape like 1x3x512x512, but got '{s}'")
+    return shape
+
+def shape_profiles(args, shape):
+    """Return the list of input shape profiles to record in meta.json"""
+    if args.shape_profiles:
+        profiles = []
+        for min_s, opt_s, max_s in args.shape_profiles:
+            p = {"min": parse_shape(min_s), "opt": parse_shape(opt_s), "max": parse_shape(max_s)}
+            for i in range(4):
+                if not p["min"][i] <= p["opt"][i] <= p["max"][i]:
+                    raise ValueError(f"Shape profile {min_s} {opt_s} {max_s} is not ordered min <= opt <= max")
+            profiles.append(p)
+        return profiles
+    if None not in shape:
+        # fixed input shape
+        return [{"min": shape, "opt": shape, "max": shape}]
+    return [DEFAULT_SHAPE_PROFILE]
+
+CALIB_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff']
+
+def calibration_images(image_dir, num):
+    files = sorted(f for f in glob.glob(os.path.join(image_dir, '**', '*'), recursive=True)
+                   if os.path.splitext(f)[1].lower() in CALIB_EXTENSIONS)
+    if not files:
+        raise ValueError(f"No calibration images found in '{image_dir}'")
+    return files[:num]
+
+def quantize_model(model_dir, transforms, image_files, algo):
+    """Replace the fp32 model (model.pdmodel/model.pdiparams) in 'model_dir' with
+    an int8 one, calibrated on 'image_files' preprocessed with 'transforms'.
+    The quantized model is meant to be run with MKLDNN (CPU) or TensorRT (GPU).
+    """
+    try:
+        from paddle.static.quantization import PostTrainingQuantization
+    except ImportError: # paddle < 2.4
+        from paddle.fluid.contrib.slim.quantization import PostTrainingQuantization
+
+    com = manager.TRANSFORMS
+    compose = T.Compose([com[t['type']](**{k: v for k, v in t.items() if k != 'type'}) for t in transforms])
+
+    def batch_generator():
+        for f in image_files:
+            im, _ = compose(f)
+            yield [np.expand_dims(im, 0).astype('float32')]
+
+    paddle.enable_static()
+    try:
+        exe = paddle.static.Executor(paddle.CPUPlace())
+        ptq = PostTrainingQuantization(
+            executor=exe,
+            model_dir=model_dir,
+            model_filename='model.pdmodel',
+            params_filename='model.pdiparams',
+            batch_generator=batch_generator,
+            batch_nums=len(image_files),
+            algo=algo,
+            quantizable_op_type=['conv2d', 'depthwise_conv2d', 'mul', 'matmul', 'matmul_v2'])
+        ptq.quantize()
+        ptq.save_quantized_model(
+            model_dir,
+            model_filename='model.pdmodel',
+            params_filename='model.pdiparams')
+    finally:
+        paddle.disable_static()
+    logger.info(f'Quantized model with {len(image_files)} calibration images ({algo}).')
     
+
+# alignment of the model and parameter files in a packed archive
+PACK_ALIGN = 4096
+WEIGHT_EXTENSIONS = ('.pdmodel', '.pdiparams')
+
+def _aligned_header(tar, info, align):
+    """Pad the (pax) header of 'info' so that its content starts at a
+    multiple of 'align' in 'tar'"""
+    for n in range(2 * align):
+        buf = info.tobuf(tar.format, tar.encoding, tar.errors)
+        if (tar.offset + len(buf)) % align == 0:
+            return
+        info.pax_headers = {'comment': ' ' * n}
+    raise ValueError(f"Can't align '{info.name}'")
+
+def write_packed(src_dir, save_path, align=PACK_ALIGN):
+    """Write the content of 'src_dir' as an uncompressed tar, with the
+    content of the weights starting on a page boundary."""
+    names = sorted(os.listdir(src_dir))
+    with tarfile.open(save_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+        for name in names:
+            path = os.path.join(src_dir, name)
+            info = tar.gettarinfo(path, arcname=name)
+            if name.endswith(WEIGHT_EXTENSIONS):
+                _aligned_header(tar, info, align)
+            with open(path, 'rb') as f:
+                tar.addfile(info, f)
+
 def main(args):
     os.environ['PADDLESEG_EXPORT_STAGE'] = 'True'
+    if args.quantize and not args.calib_images:
+        raise ValueError("--quantize requires --calib-images")
 
     seg_classes = []
     def_colors = []
@@ -167,6 +336,9 @@ def main(args):
         "model": cfg.dic["model"],
         "classes": seg_classes,
         "shape": shape,
+        "precision": "int8" if args.quantize else "fp32",
+        "output": output_kind(args),
+        "shape_profiles": shape_profiles(args, shape),
         "artifact": "@@ARTIFACT@@"
     }
     jp = Path(args.save_path)
@@ -178,18 +350,26 @@ def main(args):
         save_path = os.path.join(tmp_dir, 'model')
         paddle.jit.save(net, save_path)
 
+        transforms = cfg.export_config.get('transforms', [{
+            'type': 'Normalize'
+        }])
+        if args.quantize:
+            images = calibration_images(args.calib_images, args.calib_num)
+            quantize_model(tmp_dir, transforms, images, args.calib_algo)
+
         yml_file = os.path.join(tmp_dir, 'deploy.yaml')
         with open(yml_file, 'w') as file:
-            transforms = cfg.export_config.get('transforms', [{
-                'type': 'Normalize'
-            }])
             data = {
                 'Deploy': {
                     'transforms': transforms,
                     'model': 'model.pdmodel',
-                    'params': 'model.pdiparams'
+                    'params': 'model.pdiparams',
+                    'precision': meta['precision']
                 }
             }
+            if args.shape_range_info:
+                shutil.copyfile(args.shape_range_info, os.path.join(tmp_dir, 'shape_range_info.pbtxt'))
+                data['Deploy']['shape_range_info'] = 'shape_range_info.pbtxt'
             yaml.dump(data, file)
 
         meta_file = os.path.join(tmp_dir, 'meta.json')
@@ -197,8 +377,11 @@ def main(args):
             meta.pop("artifact",  None)
             json.dump(meta, file, indent=2) 
 
-        with tarfile.open(args.save_path, 'w:gz') as tar:
-            tar.add(tmp_dir, arcname='.')
+        if args.packed:
+            write_packed(tmp_dir, args.save_path)
+        else:
+            with tarfile.open(args.save_path, 'w:gz') as tar:
+                tar.add(tmp_dir, arcname='.')
 
     logger.info(f'Model is saved in {args.save_path}.')
 
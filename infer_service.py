@@ -15,28 +15,43 @@
 
 # Original source code taken from https://github.com/PaddlePaddle/PaddleSeg/blob/release/2.6/deploy/python/infer.py
 
+from collections import OrderedDict
+from concurrent.futures import Future
 from functools import reduce
+import hashlib
 import json
+from itertools import chain, islice
+import re
+import threading
 from typing import Any, Optional
 import warnings
 
-from predictor import DeployConfig, Predictor, adjust_image, use_auto_tune, set_logger
+from predictor import DeployConfig, Predictor, PredictorPool, decode_image, auto_tune, use_auto_tune, set_logger
+from pipeline import prefetch, imap_bounded, fan_out
+from batching import Sample, class_histograms
+from tiling import check_overlap
+from model_cache import ModelCache, extract_model, file_digest
+from result_cache import ResultCache
+from sharding import ShardedPredictor, set_logger as set_sharding_logger
+from encoders import OUTPUT_FORMATS, PngEncoderPool, compile_palette, encode_mask
+from delivery import Deliverer, set_logger as set_delivery_logger
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import os
 
-from paddleseg.utils.visualize import get_pseudo_color_map
-from PIL.ImageStat import Stat
+import numpy as np
 
 from ivcap_sdk_service import Service, Parameter, Option, Type, ServiceArgs
-from ivcap_sdk_service import register_service, deliver_data, SupportedMimeTypes
+from ivcap_sdk_service import register_service, deliver_data
 from ivcap_sdk_service import get_config as ivcap_config, create_metadata, PythonWorkflow
 import logging
-import tarfile
 import tempfile
 
 import os
 
+import startup
+startup.imported()
+
 logger = None # set when called by SDK
 
 ######
@@ -49,7 +64,34 @@ SERVICE = Service(
         Parameter(
             name='model', 
             type=Type.ARTIFACT, 
-            description='Model to use (tgz archive of all needed components)'),
+            description='Model to use (tgz archive of all needed components, or a packed tar)'),
+        Parameter(
+            name='extra-models',
+            type=Type.COLLECTION,
+            description="Further models to apply to the same images. Each image is downloaded and decoded "
+            "only once, and models with the same transforms share the preprocessing.",
+            optional=True),
+        Parameter(
+            name='model-cache-dir',
+            type=Type.STRING,
+            description='If set, keep extracted models in this directory and reuse them in later orders.',
+            optional=True),
+        Parameter(
+            name='model-cache-size',
+            type=Type.INT,
+            description="Max size (in MB) of 'model-cache-dir' before least recently used models are evicted.",
+            default=4096),
+        Parameter(
+            name='result-cache-dir',
+            type=Type.STRING,
+            description='If set, keep the masks of processed images in this directory and deliver them again, '
+            'instead of running inference, for images with the same content, model and preprocessing.',
+            optional=True),
+        Parameter(
+            name='result-cache-size',
+            type=Type.INT,
+            description="Max size (in MB) of 'result-cache-dir' before least recently used masks are evicted.",
+            default=2048),
         Parameter(
             name='images', 
             type=Type.COLLECTION, 
@@ -64,6 +106,66 @@ SERVICE = Service(
             type=Type.INT, 
             description='Mini batch size of one gpu or cpu.',
             default=1),
+        Parameter(
+            name='pad-multiple',
+            type=Type.INT,
+            description='Images in a batch are padded to a multiple of this many pixels. Images with the same '
+            'padded size are batched together. Not used with a batch-size of 1.',
+            default=32),
+        Parameter(
+            name='tile-size',
+            type=Type.INT,
+            description="If set, run inference on overlapping tiles of this many pixels square and blend the "
+            "results into a full resolution mask. 'max-img-size' is ignored in this mode. Every image in flight "
+            "is still held at full resolution (12 bytes per pixel once preprocessed), so lower 'pipeline-depth' "
+            "and 'prefetch-depth' for very large images.",
+            optional=True),
+        Parameter(
+            name='tile-overlap',
+            type=Type.INT,
+            description="Number of pixels neighbouring tiles overlap by (the stride is 'tile-size' - 'tile-overlap'). "
+            "Must be less than half of 'tile-size'.",
+            default=64),
+        Parameter(
+            name='preprocess-workers',
+            type=Type.INT,
+            description='Number of threads decoding and transforming images ahead of inference.',
+            default=2),
+        Parameter(
+            name='deliver-workers',
+            type=Type.INT,
+            description='Number of threads encoding results behind inference.',
+            default=2),
+        Parameter(
+            name='deliver-in-flight',
+            type=Type.INT,
+            description='Max number of result uploads in progress at the same time.',
+            default=8),
+        Parameter(
+            name='deliver-retries',
+            type=Type.INT,
+            description='Number of times a failed result upload is retried (with exponential backoff).',
+            default=3),
+        Parameter(
+            name='pipeline-depth',
+            type=Type.INT,
+            description='Max number of batches queued between the preprocess, inference and delivery stages.',
+            default=4),
+        Parameter(
+            name='prefetch-depth',
+            type=Type.INT,
+            description='Max number of images fetched and resized ahead of the predictor.',
+            default=4),
+        Parameter(
+            name='download-workers',
+            type=Type.INT,
+            description='Number of images of the collection downloaded (and decoded) concurrently.',
+            default=4),
+        Parameter(
+            name='download-budget',
+            type=Type.INT,
+            description='Stop downloading ahead while this many MB of downloaded images are waiting to be processed.',
+            default=512),
         Parameter(
             name='device',
             type=Type.OPTION,
@@ -90,16 +192,34 @@ SERVICE = Service(
             type=Type.BOOL,
             description='Whether to enable tuned dynamic shape. We uses some images to collect '
             'the dynamic shape for trt sub graph, which avoids setting dynamic shape manually.'),
-        # Parameter(
-        #     name='auto-tuned-shape-file',
-        #     type=Type.STRING,
-        #     default="auto_tune_tmp.pbtxt",
-        #     description='The temp file to save tuned dynamic shape.'),
+        Parameter(
+            name='auto-tune-images',
+            type=Type.INT,
+            default=10,
+            description='Number of images (from the start of the collection) used to auto tune the dynamic shape.'),
+        Parameter(
+            name='shape-cache-dir',
+            type=Type.STRING,
+            description='If set, keep auto tuned shapes in this directory and reuse them in later orders with '
+            'the same model and image size settings.',
+            optional=True),
+        Parameter(
+            name='optim-cache-dir',
+            type=Type.STRING,
+            description='If set, save the optimised program (or serialised TensorRT engines) in this directory '
+            'and load it from there in later orders, instead of optimising the model again.',
+            optional=True),
         Parameter(
             name='cpu-threads',
             default=10,
             type=Type.INT,
             description='Number of threads to predict when using cpu.'),
+        Parameter(
+            name='cpu-workers',
+            default=1,
+            type=Type.INT,
+            description="Number of predictor processes to run when using cpu. Each one is pinned to its own "
+            "share of the available cores and uses one thread per core (overrides 'cpu-threads')."),
         Parameter(
             name='enable-mkldnn',
             type=Type.BOOL,
@@ -116,7 +236,26 @@ SERVICE = Service(
         Parameter(
             name='with-argmax',
             type=Type.BOOL,
-            description='Perform argmax operation on the predict result.'),
+            description='Perform argmax operation on the predict result. No longer needed, models which '
+            'return class scores are reduced to labels automatically.'),
+        Parameter(
+            name='output-format',
+            type=Type.OPTION,
+            options=[Option(value=f) for f in OUTPUT_FORMATS],
+            default='pseudo-png',
+            description="Format of the delivered masks: a pseudo colour (palette) PNG, a JSON file with a COCO RLE "
+            "mask per class, or the raw uint8 label map as '.npy' (optionally zstd compressed)."),
+        Parameter(
+            name='png-compress-level',
+            type=Type.INT,
+            default=6,
+            description="zlib compression level (0-9) of 'pseudo-png' masks. Lower levels encode faster."),
+        Parameter(
+            name='encode-processes',
+            type=Type.INT,
+            description="If set, encode 'pseudo-png' masks in this many processes instead of the "
+            "'deliver-workers' threads.",
+            optional=True),
         Parameter(
             name='print-detail',
             type=Type.BOOL,
@@ -128,36 +267,133 @@ SERVICE = Service(
 ######
 # 2. Service entry point
 #
-def service(args: ServiceArgs, svc_logger: logging):
+def service(args: ServiceArgs, svc_logger: logging, predictors: Optional[PredictorPool] = None):
     """Called after the service has started and all paramters have been parsed and validated
 
     Args:
         args (ServiceArgs): A Dict where the key is one of the `Parameter` defined in the above `SERVICE`
         svc_logger (logging): Logger to use for reporting information on the progress of execution
+        predictors (PredictorPool): Pool of warm predictors to use (see 'worker.py'). If not set, a
+            new predictor is created for this order
     """
     global logger
     logger = svc_logger
     set_logger(svc_logger)
+    set_sharding_logger(svc_logger)
+    set_delivery_logger(svc_logger)
+    if args.tile_size:
+        check_overlap(args.tile_size, args.tile_overlap)
+    timer = startup.begin()
 
     with tempfile.TemporaryDirectory() as tmp_dir:
         io_mgr = IOManager(args, tmp_dir)
-
-        # collect dynamic shape by auto_tune
-        # if use_auto_tune(args):
-        #     tune_img_nums = 10
-        #     auto_tune(args, imgs_list, tune_img_nums)
-
-        # create and run predictor
-        predictor = Predictor(args, io_mgr.get_config())
-        predictor.run(io_mgr)
-
-        if use_auto_tune(args) and \
-            os.path.exists(args.auto_tuned_shape_file):
-            os.remove(args.auto_tuned_shape_file)
-
-        if args.benchmark:
-            predictor.autolog.report()
-
+        timer.mark('model-load')
+        runs = []
+        try:
+            for output in io_mgr.outputs:
+                # collect dynamic shape by auto_tune
+                shape_file = None
+                if use_auto_tune(args):
+                    shape_file = tuned_shape_file(args, io_mgr, output, tmp_dir)
+                # create (or reuse) predictor
+                runs.append(create_predictor(args, output, predictors, shape_file))
+            timer.mark('predictor-build')
+
+            if len(runs) == 1:
+                runs[0].run(io_mgr)
+            else:
+                run_fan_out(args, io_mgr, runs)
+        except BaseException:
+            # a delivery error raised while closing must not hide the original error
+            try:
+                io_mgr.close()
+            except Exception as err:
+                logger.warning(f"Closing the order after a failure failed as well: {err}")
+            raise
+        io_mgr.close()
+        logger.info(timer.report())
+
+        for predictor in runs:
+            if args.benchmark and hasattr(predictor, 'autolog'):
+                # sharded predictors report from within their worker processes
+                predictor.autolog.report()
+
+def create_predictor(args: ServiceArgs, output: 'ModelOutput', predictors: Optional[PredictorPool],
+                     shape_file: Optional[str]):
+    if args.device == 'cpu' and args.cpu_workers > 1:
+        return ShardedPredictor(args, output.model_dir, args.cpu_workers)
+    if predictors is not None:
+        return predictors.get(args, output.cfg, shape_file)
+    return Predictor(args, output.cfg, shape_file)
+
+def run_fan_out(args: ServiceArgs, io_mgr: 'IOManager', runs):
+    """Run the predictors of several models over one stream of decoded images.
+
+    Each image is downloaded and decoded once. Models with the same
+    transforms also share the preprocessing, each of the remaining steps
+    (inference, encoding, delivery) runs per model, on its own thread.
+    """
+    groups = OrderedDict()
+    for output, predictor in zip(io_mgr.outputs, runs):
+        groups.setdefault(output.cfg.transforms_key, []).append((output, predictor))
+    logger.info(f"Running {len(runs)} models with {len(groups)} distinct preprocessing configurations")
+
+    depth = max(args.pipeline_depth * args.batch_size, 1)
+    # stops all models as soon as one of them fails
+    cancel = threading.Event()
+    streams = []
+    for images, members in zip(fan_out(io_mgr, len(groups), args.prefetch_depth, cancel), groups.values()):
+        cfg = members[0][0].cfg
+        samples = imap_bounded(lambda item, cfg=cfg: Sample(item[0], cfg.preprocess(item[1])),
+                               images, args.preprocess_workers, depth)
+        for branch, (output, predictor) in zip(fan_out(samples, len(members), depth, cancel), members):
+            streams.append((predictor, ModelStream(branch, output)))
+
+    errors = []
+    def run(predictor, stream):
+        try:
+            predictor.run(stream)
+        except BaseException as err:
+            logger.exception(err)
+            errors.append(err)
+            cancel.set()
+    threads = [threading.Thread(target=run, args=s, name=f"model-{i}") for i, s in enumerate(streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+def tuned_shape_file(args: ServiceArgs, io_mgr: 'IOManager', output: 'ModelOutput', tmp_dir: str) -> Optional[str]:
+    """Return the auto tuned shape file to use for 'output's model in this order.
+
+    A shape file bundled with the model takes precedence. Otherwise the shapes
+    are tuned on the first 'auto-tune-images' images of the collection, and
+    kept in 'shape-cache-dir' (if set) for later orders. Returns None if
+    tuning failed.
+    """
+    cfg = output.cfg
+    if cfg.shape_file and os.path.exists(cfg.shape_file):
+        logger.info("Using auto tuned shape bundled with the model")
+        return cfg.shape_file
+
+    if args.shape_cache_dir:
+        # the shapes depend on how images are resized and batched
+        k = json.dumps([output.model_digest, io_mgr.max_img_size, args.tile_size, args.tile_overlap,
+                        args.pad_multiple, args.batch_size])
+        os.makedirs(args.shape_cache_dir, exist_ok=True)
+        path = os.path.join(args.shape_cache_dir, f"{hashlib.sha256(k.encode()).hexdigest()[:32]}.pbtxt")
+        if os.path.exists(path):
+            logger.info(f"Using cached auto tuned shape '{path}'")
+            return path
+    else:
+        path = os.path.join(tmp_dir, f"auto_tune-{output.index}.pbtxt")
+
+    images = [data for _, data in io_mgr.peek(args.auto_tune_images)]
+    if images:
+        auto_tune(args, cfg, images, path)
+    return path if os.path.exists(path) else None
 
 ######
 # 3. I/O and interface to Predictor
@@ -167,32 +403,153 @@ class IOManager:
         self.args = args
         #logger.info(f"image name: '{img_name}' path: '{args.image.path}' - isfile: {os.path.isfile(args.image.path)}")
         #self.img_list, _ = get_image_list(args.image.path)
-        self.img_list = []
         self.images = {}
-        for img in args.images:
-            imgA = adjust_image(img, args.max_img_size)
-            self.img_list.append(imgA)
-            self.images[imgA] = img
-        logger.info(f"Image list '{self.img_list}'")
-        self.batch_size = args.batch_size
+        self._refs = {} # image key -> number of models which haven't delivered a result for it yet
+        self._lock = threading.Lock()
+        self.prefetch_depth = args.prefetch_depth
+        self._stream = None # set by 'peek'
+        # tiled inference works on the full resolution image
+        self.max_img_size = -1 if args.tile_size else args.max_img_size
 
         self.save_dir = '/tmp'
-
-        logger.info(f"Opening model '{args.model.name}'.")
-        tf = tarfile.open(args.model.as_local_file(), 'r|gz')
-        tf.extractall(tmp_dir)
-        deployPath = os.path.join(tmp_dir, 'deploy.yaml')
-        self.cfg = DeployConfig(deployPath)
-        
-        with open(os.path.join(tmp_dir, 'meta.json')) as f:
-            self.meta = json.load(f)
-            self.classes = self.meta.get("classes", None)
+        self.deliverer = Deliverer(deliver_data, args.deliver_in_flight, args.deliver_retries)
+
+        self.result_cache = None
+        if args.result_cache_dir:
+            self.result_cache = ResultCache(args.result_cache_dir, args.result_cache_size * 1024 * 1024)
+            # everything besides model and image content which changes the mask
+            self.result_params = {
+                'max_img_size': self.max_img_size,
+                'tile_size': args.tile_size,
+                'tile_overlap': args.tile_overlap if args.tile_size else None,
+                # zero padding changes the output near the bottom and right edges
+                'pad_multiple': args.pad_multiple if not args.tile_size and args.batch_size > 1 else None,
+                'device': args.device,
+                'precision': args.precision if args.device == 'gpu' and args.use_trt else None,
+                'enable_mkldnn': args.enable_mkldnn if args.device == 'cpu' else None,
+            }
+
+        self.png_pool = None
+        if args.encode_processes and args.output_format == 'pseudo-png':
+            self.png_pool = PngEncoderPool(args.encode_processes)
+
+        models = [args.model] + list(args.extra_models or [])
+        self.outputs = [ModelOutput(self, m, i, tmp_dir) for i, m in enumerate(models)]
 
     def __repr__(self):
-        return f"IOManager(batch_size={self.batch_size }, save_dir={self.save_dir}, img_list={self.img_list})"
+        return f"IOManager(prefetch_depth={self.prefetch_depth}, save_dir={self.save_dir})"
+
+    def open_model(self, model, dir: str):
+        """Return the directory holding the content of 'model' (extracted into
+        'dir' unless 'model-cache-dir' is set), and the archive's digest"""
+        archive = model.as_local_file()
+        needs_digest = self.args.model_cache_dir or self.result_cache or self.args.shape_cache_dir
+        digest = file_digest(archive) if needs_digest else None
+        if self.args.model_cache_dir:
+            cache = ModelCache(self.args.model_cache_dir, self.args.model_cache_size * 1024 * 1024)
+            model_dir = cache.get(model.name, archive, digest)
+            logger.info(f"Using cached model in '{model_dir}'")
+            return model_dir, digest
+        extract_model(archive, dir)
+        return dir, digest
+
+    def close(self):
+        """Wait for all results to be delivered"""
+        try:
+            if self.png_pool:
+                self.png_pool.close()
+        finally:
+            self.deliverer.close()
 
     def get_config(self) -> DeployConfig:
-        return self.cfg
+        return self.outputs[0].cfg
+
+    def save_imgs(self, results, keys):
+        self.outputs[0].save_imgs(results, keys)
+
+    def release(self, key):
+        """Called once a model is done with image 'key'"""
+        with self._lock:
+            n = self._refs.pop(key) - 1
+            if n > 0:
+                self._refs[key] = n
+            else:
+                self.images.pop(key)
+
+    def __iter__(self):
+        """Return an iterator over (key, image) pairs, where image is the
+        decoded image and key is used to refer to it in 'save_imgs'.
+
+        Images are fetched and adjusted lazily on a background thread, at most
+        'prefetch-depth' images ahead of the consumer. Batching is left to the
+        'Predictor' which groups images by shape.
+        """
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            return stream
+        return prefetch(self._fetch_images(), self.prefetch_depth)
+
+    def peek(self, n: int):
+        """Return the first 'n' (key, image) pairs without consuming them,
+        the next iteration still starts with the first image"""
+        stream = iter(self)
+        head = list(islice(stream, n))
+        self._stream = chain(head, stream)
+        return head
+
+    def _fetch_images(self):
+        # download (and decode) several images concurrently, but in order
+        budget = self.args.download_budget * 1024 * 1024
+        fetched = imap_bounded(self._fetch_image, enumerate(self.args.images),
+                               self.args.download_workers, 2 * self.args.download_workers,
+                               budget=budget, cost=lambda r: r[3])
+        for key, img, data, _ in fetched:
+            if data is None:
+                continue # delivered from the result cache
+            logger.debug(f"... supplying image: {img.name} {data.shape}")
+            yield key, data
+
+    def _fetch_image(self, item):
+        key, img = item
+        path = img.as_local_file()
+        with self._lock:
+            self.images[key] = img
+            self._refs[key] = len(self.outputs)
+        if self.result_cache:
+            digest = file_digest(path)
+            for output in self.outputs:
+                rkey = self.result_cache.key(output.model_digest, self.result_params, digest)
+                label = self.result_cache.get(rkey)
+                if label is None:
+                    output.result_keys[key] = rkey
+                    continue
+                logger.info(f"Delivering cached result of '{output.artifact.name}' for image '{img.name}'")
+                output.cached.add(key)
+                output.save_imgs([label], [key])
+            if all(key in output.cached for output in self.outputs):
+                return key, img, None, 0
+        logger.info(f"Checking if image '{img.name}' needs adjusting (max-size: {self.max_img_size})")
+        data = decode_image(path, self.max_img_size)
+        return key, img, data, os.path.getsize(path)
+
+
+class ModelOutput:
+    """One of the models of an order, and how its results are delivered"""
+    def __init__(self, io_mgr: IOManager, model, index: int, tmp_dir: str):
+        self.io_mgr = io_mgr
+        self.args = io_mgr.args
+        self.artifact = model
+        self.index = index
+        self.result_keys = {} # image key -> result cache key, for images not found in the cache
+        self.cached = set()   # keys of images delivered from the result cache
+
+        logger.info(f"Opening model '{model.name}'.")
+        self.model_dir, self.model_digest = io_mgr.open_model(model, os.path.join(tmp_dir, f"model-{index}"))
+        self.cfg = DeployConfig(os.path.join(self.model_dir, 'deploy.yaml'))
+
+        self.meta = self.cfg.meta
+        self.classes = self.meta.get("classes", None)
+        self.palette = compile_palette(self.get_colormap())
 
     def  get_colormap(self) -> Optional[Any]:
         c = self.meta.get("classes", None)
@@ -207,63 +564,79 @@ class IOManager:
         cm = reduce(r, c, [])
         return cm
 
-    def save_imgs(self, results, imgs_path):
-        logger.debug(f"... save_imgs shape: {results.shape} img_path: {imgs_path}")
+    def save_imgs(self, results, keys):
+        logger.debug(f"... save_imgs count: {len(results)} keys: {keys}")
 
-        cm = self.get_colormap()
-        for i in range(results.shape[0]):
-            result = results[i]
-            img = self.images[imgs_path[i]]
+        hists = class_histograms(results, len(self.classes))
+        # start encoding all of them before waiting for the first one
+        encoded = [self._encode(r) for r in results]
+        for i, result in enumerate(results):
+            img = self.io_mgr.images[keys[i]]
             img_name = img.name
-            pseudo_img = get_pseudo_color_map(result, cm)
-            stats = Stat(pseudo_img)
-            logger.debug(f'... count: {stats.count} shape: {result.shape}')
+            enc = encoded[i].result() if isinstance(encoded[i], Future) else encoded[i]
+            logger.debug(f'... count: {result.size} shape: {result.shape}')
             basename = os.path.basename(img_name)
             basename, _ = os.path.splitext(basename)
-            basename = f'{basename}.pseudo.png'
+            if self.index > 0:
+                # keep the results of the models apart
+                basename = f'{basename}.{model_label(self.artifact, self.meta)}'
+            basename = f'{basename}{enc.suffix}'
 
             meta = create_metadata('urn:ibenthos:schema:paddle.seg.inference.1', {
                 'image': img_name,
-                'model': self.args.model.name,
+                'model': self.artifact.name,
                 'width': result.shape[0],
                 'height': result.shape[1],
-                'cover': self.get_cover(stats),
+                'cover': self.get_cover(hists[i], result.size),
+                'format': self.args.output_format,
                 #'params': self.args._asdict(),
                 'order-id': ivcap_config().ORDER_ID,
             })
-            url = deliver_data(basename, lambda f: pseudo_img.save(f, format='png'), SupportedMimeTypes.PNG, metadata=meta) 
-            logger.debug(f"Saved pseudo colored image ({pseudo_img}) type as '{url}'")
+            self.io_mgr.deliverer.submit(basename, enc.data, enc.mime_type, metadata=meta)
+            logger.debug(f"Queued '{basename}' ({len(enc.data)} bytes) for delivery")
+
+            rkey = self.result_keys.pop(keys[i], None)
+            if rkey:
+                self.io_mgr.result_cache.put(rkey, result)
+            self.io_mgr.release(keys[i])
 
-    def get_cover(self, stats: Stat):
+    def _encode(self, label: np.ndarray):
+        if self.io_mgr.png_pool:
+            return self.io_mgr.png_pool.submit(label, self.palette, self.args.png_compress_level)
+        return encode_mask(label, self.args.output_format, self.palette, self.classes, self.args.png_compress_level)
+
+    def get_cover(self, hist: np.ndarray, count: int):
         cover = []
-        count = stats.count[0]
         for i, cl in enumerate(self.classes):
             m = cl.copy()
             m['color'] = m.pop("def_color",  None)
-            m['cover'] = 1.0 * stats.h[i] / count
+            m['cover'] = 1.0 * hist[i] / count
+            m['pixels'] = int(hist[i])
             cover.append(m)
         return cover
-            
-            
-        
+
+
+class ModelStream:
+    """What the 'Predictor' of one of several models sees of the order:
+    the images already preprocessed (see 'run_fan_out'), minus those found
+    in the result cache, and the model's own 'save_imgs'."""
+    preprocessed = True
+
+    def __init__(self, samples, output: ModelOutput):
+        self.samples = samples
+        self.output = output
+
     def __iter__(self):
-        return self.Iter(self)
-
-    class Iter:
-        def __init__(self, outer):
-            self.outer = outer
-            self.n = 0
-
-        def __next__(self):
-            iml = self.outer.img_list
-            batch_size = self.outer.batch_size
-            if self.n < len(iml):
-                result = iml[self.n:self.n + batch_size]
-                self.n += batch_size
-                logger.debug(f"... supplying images: {result}")
-                return result
-            else:
-                raise StopIteration
+        return (s for s in self.samples if s.key not in self.output.cached)
+
+    def save_imgs(self, results, keys):
+        self.output.save_imgs(results, keys)
+
+
+def model_label(model, meta) -> str:
+    """Short name for 'model' used in the names of its results"""
+    name = meta.get("name") or os.path.splitext(os.path.basename(model.name))[0]
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', name)
 
 
 ######
@@ -271,7 +644,9 @@ class IOManager:
 #
 # Register this service with IVCAP which in turn
 # will call 'service' with the relevant parameters
-# defined in 'SERVICE'
+# defined in 'SERVICE'. Guarded, so that 'worker.py' can import
+# this module without starting an order.
 #
-register_service(SERVICE, service)
+if __name__ == '__main__':
+    register_service(SERVICE, service)
 
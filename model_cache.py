@@ -0,0 +1,174 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# On-disk cache of extracted model archives, shared by all runs on a node,
+# and support for 'packed' model archives.
+#
+# A packed archive (see 'export_model/export.py --packed') is an uncompressed
+# tar with the content of the model and parameter files aligned to pages.
+# Extracting it is a plain copy instead of
+# a gunzip, done with 'os.copy_file_range' so that the kernel copies (or, on
+# file systems supporting it, shares) the blocks without passing them through
+# this process. The model is then loaded from the extracted files as usual.
+
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+from typing import Optional
+
+TMP_PREFIX = ".tmp-"
+STALE_TMP_SECS = 3600
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return the sha256 hex digest of the file at 'path'"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def is_packed(archive: str) -> bool:
+    """True if 'archive' is an uncompressed (packed) model archive"""
+    with open(archive, 'rb') as f:
+        if f.read(2) == b'\x1f\x8b':
+            return False # gzip
+    return tarfile.is_tarfile(archive)
+
+def extract_model(archive: str, dir: str):
+    """Extract the model 'archive' (a tgz file, or a packed archive) into 'dir'"""
+    if is_packed(archive):
+        extract_packed(archive, dir)
+        return
+    with tarfile.open(archive, 'r|gz') as tf:
+        tf.extractall(dir)
+
+def extract_packed(archive: str, dir: str):
+    """Extract the packed 'archive' into 'dir', copying file content within the kernel"""
+    with tarfile.open(archive, 'r:') as tf, open(archive, 'rb') as src:
+        for m in tf:
+            if not m.isfile():
+                tf.extract(m, dir)
+                continue
+            name = os.path.normpath(m.name)
+            if os.path.isabs(name) or name.startswith('..'):
+                raise ValueError(f"Refusing to extract '{m.name}' outside of '{dir}'")
+            path = os.path.join(dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as dst:
+                _copy_range(src, dst, m.offset_data, m.size)
+
+def _copy_range(src, dst, offset: int, size: int):
+    """Append 'size' bytes at 'offset' of 'src' to 'dst'"""
+    try:
+        while size > 0:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), size, offset)
+            if n == 0:
+                break
+            offset += n
+            size -= n
+    except (AttributeError, OSError):
+        pass # not on Linux, or not supported between these file systems
+    src.seek(offset)
+    while size > 0:
+        chunk = src.read(min(size, 1 << 20))
+        if not chunk:
+            break
+        dst.write(chunk)
+        size -= len(chunk)
+    if size > 0:
+        raise EOFError(f"'{src.name}' is truncated")
+
+def dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+class ModelCache:
+    """Keeps extracted model archives in 'root', keyed by artifact URN and
+    content hash, so that repeated orders for the same model don't need to
+    gunzip the archive again.
+
+    Entries are populated in a temporary directory and atomically renamed
+    into place, which makes it safe for several processes to share 'root'.
+    Whenever a new entry is added, the least recently used entries are
+    removed until the cache is no larger than 'max_bytes'.
+    """
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, urn: str, digest: str) -> str:
+        return f"{re.sub(r'[^A-Za-z0-9.-]+', '_', urn)}-{digest[:16]}"
+
+    def get(self, urn: str, archive: str, digest: Optional[str] = None) -> str:
+        """Return the directory holding the extracted content of 'archive'
+
+        Args:
+            urn (str): ID of the model artifact
+            archive (str): Local path of the model archive
+            digest (str): 'file_digest' of 'archive', if already known
+        """
+        path = os.path.join(self.root, self.key(urn, digest or file_digest(archive)))
+        if os.path.isdir(path):
+            os.utime(path)
+            return path
+
+        tmp = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.root)
+        try:
+            extract_model(archive, tmp)
+            os.rename(tmp, path)
+        except OSError:
+            # another process got there first
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str = None):
+        """Remove least recently used entries (never 'keep') until the
+        cache fits into 'max_bytes'"""
+        with open(os.path.join(self.root, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            now = time.time()
+            for name in os.listdir(self.root):
+                p = os.path.join(self.root, name)
+                if not os.path.isdir(p):
+                    continue
+                mtime = os.path.getmtime(p)
+                if name.startswith(TMP_PREFIX):
+                    # left behind by a process which died while extracting
+                    if now - mtime > STALE_TMP_SECS:
+                        shutil.rmtree(p, ignore_errors=True)
+                    continue
+                entries.append((mtime, dir_size(p), p))
+            total = sum(e[1] for e in entries)
+            for mtime, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if p == keep:
+                    continue
+                shutil.rmtree(p, ignore_errors=True)
+                total -= size
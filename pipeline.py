@@ -0,0 +1,192 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Small building blocks for running the preprocess, inference and delivery
+# stages of a prediction concurrently, connected by bounded queues.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+def imap_bounded(fn: Callable[[Any], Any], items: Iterable[Any], workers: int, depth: int,
+                 budget: int = 0, cost: Optional[Callable[[Any], int]] = None) -> Iterator[Any]:
+    """Apply 'fn' to every element of 'items' on a pool of worker threads.
+
+    Results are returned in the order of 'items'. At most 'depth' elements are
+    in flight at any time, so a slow consumer stalls the workers (backpressure)
+    instead of letting results pile up in memory.
+
+    If 'budget' is set, no further elements are submitted while the 'cost'
+    of the results which are ready but not yet consumed exceeds 'budget'.
+
+    Args:
+        fn (Callable): Function applied to each element
+        items (Iterable): Source of elements
+        workers (int): Number of worker threads
+        depth (int): Max number of elements submitted but not yet consumed
+        budget (int): Max total cost of finished but not yet consumed results (0 for no limit)
+        cost (Callable): Returns the cost (e.g. size in bytes) of a result
+    """
+    depth = max(depth, workers, 1)
+
+    def over_budget(pending) -> bool:
+        if budget <= 0 or cost is None:
+            return False
+        done = [f for f in pending if f.done() and f.exception() is None]
+        return sum(cost(f.result()) for f in done) > budget
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            while pending and (len(pending) >= depth or over_budget(pending)):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class BoundedSink:
+    """Hands work items to a pool of worker threads, blocking the caller
+    whenever more than 'depth' of them are still outstanding.
+
+    Any exception raised by a worker is re-raised in the caller on a
+    subsequent 'submit' or at the latest in 'close'.
+    """
+    def __init__(self, fn: Callable[..., Any], workers: int, depth: int):
+        self.fn = fn
+        self.depth = max(depth, workers, 1)
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._pending = deque()
+
+    def submit(self, *args):
+        self._pending.append(self._executor.submit(self.fn, *args))
+        while len(self._pending) > self.depth or (self._pending and self._pending[0].done()):
+            self._pending.popleft().result()
+
+    def close(self):
+        """Wait for all outstanding work items to finish"""
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # don't mask the original error, but don't leave threads behind either
+            for f in self._pending:
+                f.cancel()
+            self._pending.clear()
+        self.close()
+
+_END = object()
+
+def prefetch(items: Iterable[Any], depth: int) -> Iterator[Any]:
+    """Iterate over 'items' on a background thread, staying at most 'depth'
+    elements ahead of the consumer.
+
+    Exceptions raised while producing an element are re-raised in the
+    consumer when it reaches that element.
+    """
+    q = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(el) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(el, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+
+    t = threading.Thread(target=produce, name="prefetch", daemon=True)
+    t.start()
+    try:
+        while True:
+            item, err = q.get()
+            if item is _END:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+
+def fan_out(items: Iterable[Any], n: int, depth: int,
+            cancel: Optional[threading.Event] = None) -> List[Iterator[Any]]:
+    """Hand every element of 'items' to 'n' consumers, each iterating over
+    one of the returned iterators (on its own thread).
+
+    'items' is iterated on a background thread which stays at most 'depth'
+    elements ahead of the slowest consumer. A consumer which stops early is
+    skipped from then on. Exceptions raised while producing an element are
+    re-raised in every consumer. Once 'cancel' is set, production stops and
+    all iterators end.
+    """
+    cancel = cancel or threading.Event()
+    queues = [queue.Queue(maxsize=max(depth, 1)) for _ in range(n)]
+    closed = [threading.Event() for _ in range(n)]
+
+    def put(i, el):
+        while not closed[i].is_set() and not cancel.is_set():
+            try:
+                queues[i].put(el, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        err = None
+        try:
+            for item in items:
+                if cancel.is_set() or all(c.is_set() for c in closed):
+                    return
+                for i in range(n):
+                    put(i, (item, None))
+        except BaseException as e:
+            err = e
+        for i in range(n):
+            put(i, (_END, err))
+
+    def consume(i):
+        try:
+            while not cancel.is_set():
+                try:
+                    item, err = queues[i].get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    if err is not None:
+                        raise err
+                    return
+                yield item
+        finally:
+            closed[i].set()
+
+    threading.Thread(target=produce, name="fan-out", daemon=True).start()
+    return [consume(i) for i in range(n)]
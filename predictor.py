@@ -21,29 +21,40 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 import yaml
 import numpy as np
-from paddle.inference import create_predictor, PrecisionType
-from paddle.inference import Config as PredictConfig
 import os
 
-import paddleseg.transforms as T
-from paddleseg.cvlibs import manager
+# paddle and paddleseg take seconds to import, so paddle is only imported
+# once a predictor is built (see 'paddle_inference'), and paddleseg only for
+# models whose transforms can't be compiled (see 'load_transforms')
 # from paddleseg.utils import get_sys_env, get_image_list
 # from paddleseg.utils.visualize import get_pseudo_color_map
 # from PIL.ImageStat import Stat
-from PIL import Image
+from PIL import Image, ImageOps
 
 # from ivcap_sdk_service import Service, Parameter, Option, Type, ServiceArgs
 # from ivcap_sdk_service import register_service, deliver_data, SupportedMimeTypes
 # from ivcap_sdk_service import get_config as ivcap_config, create_metadata, PythonWorkflow
 import logging
 # import tarfile
-import tempfile
 
-from typing import Dict
+from collections import OrderedDict
+import gc
+from typing import Dict, Optional
 
 import codecs
+import copy
+import hashlib
 import os
-# import json
+import json
+import shutil
+import tempfile
+
+from pipeline import imap_bounded, BoundedSink
+from batching import BufferPool, Sample, bucket_batches, crop
+from tiling import Tiler
+from model_cache import TMP_PREFIX, file_digest
+from preprocess import compile_transforms
+import startup
 
 logger = None # set when called by SDK
 
@@ -51,50 +62,60 @@ def set_logger(l: logging):
     global logger
     logger = l
 
+def paddle_inference():
+    """Return the 'paddle.inference' module, importing it on first use"""
+    import paddle.inference
+    startup.mark('paddle-import')
+    return paddle.inference
+
 def use_auto_tune(args):
+    if not (args.device == "gpu" and args.use_trt and args.enable_auto_tune):
+        return False
+    PredictConfig = paddle_inference().Config
     return hasattr(PredictConfig, "collect_shape_range_info") \
-        and hasattr(PredictConfig, "enable_tuned_tensorrt_dynamic_shape") \
-        and args.device == "gpu" and args.use_trt and args.enable_auto_tune
+        and hasattr(PredictConfig, "enable_tuned_tensorrt_dynamic_shape")
 
-def auto_tune(args, imgs, img_nums):
+def auto_tune(args, cfg, imgs, shape_file):
     """
     Use images to auto tune the dynamic shape for trt sub graph.
-    The tuned shape saved in args.auto_tuned_shape_file.
+    The tuned shape saved in shape_file.
 
     Args:
         args(dict): input args.
-        imgs(str, list[str], numpy): the path for images or the origin images.
-        img_nums(int): the nums of images used for auto tune.
+        cfg(DeployConfig): the model to tune.
+        imgs(list[numpy]): the decoded images (as supplied by the IOManager).
+        shape_file(str): the file to save the tuned shape in.
     Returns:
         None
     """
-    logger.info("Auto tune the dynamic shape for GPU TRT.")
+    logger.info(f"Auto tune the dynamic shape for GPU TRT with {len(imgs)} images.")
 
     assert use_auto_tune(args), "Do not support auto_tune, which requires " \
         "device==gpu && use_trt==True && paddle >= 2.2"
 
-    if not isinstance(imgs, (list, tuple)):
-        imgs = [imgs]
-    num = min(len(imgs), img_nums)
-
-    cfg = DeployConfig(args.cfg)
-    pred_cfg = PredictConfig(cfg.model, cfg.params)
+    # written next to 'shape_file' and renamed once complete, as
+    # 'shape_file' may be shared with other orders
+    tmp_file = f"{shape_file}.{os.getpid()}.tmp"
+    pi = paddle_inference()
+    pred_cfg = pi.Config(cfg.model, cfg.params)
     pred_cfg.enable_use_gpu(100, 0)
     if not args.print_detail:
         pred_cfg.disable_glog_info()
-    pred_cfg.collect_shape_range_info(args.auto_tuned_shape_file)
+    pred_cfg.collect_shape_range_info(tmp_file)
 
-    predictor = create_predictor(pred_cfg)
+    predictor = pi.create_predictor(pred_cfg)
     input_names = predictor.get_input_names()
     input_handle = predictor.get_input_handle(input_names[0])
 
-    for i in range(0, num):
-        if isinstance(imgs[i], str):
-            data = np.array([cfg.transforms(imgs[i])[0]])
-        else:
-            data = imgs[i]
-        input_handle.reshape(data.shape)
-        input_handle.copy_from_cpu(data)
+    # run the same batch shapes as 'Predictor.run' will
+    samples = [Sample(i, cfg.preprocess(img)) for i, img in enumerate(imgs)]
+    if args.tile_size:
+        batches = bucket_batches(Tiler(args.tile_size, args.tile_overlap).split(samples), args.batch_size, args.tile_size)
+    else:
+        batches = bucket_batches(samples, args.batch_size, args.pad_multiple)
+    for batch in batches:
+        input_handle.reshape(batch.data.shape)
+        input_handle.copy_from_cpu(batch.data)
         try:
             predictor.run()
         except Exception as e:
@@ -103,26 +124,104 @@ def auto_tune(args, imgs, img_nums):
                 "Auto tune failed. Usually, the error is out of GPU memory "
                 "for the model or image is too large. \n")
             del predictor
-            if os.path.exists(args.auto_tuned_shape_file):
-                os.remove(args.auto_tuned_shape_file)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
             return
 
-    logger.info("Auto tune success.\n")
+    # the shape info is written when the predictor is destroyed
+    del predictor
+    gc.collect()
+    if os.path.exists(tmp_file):
+        os.replace(tmp_file, shape_file)
+        logger.info("Auto tune success.\n")
+    else:
+        logger.info("Auto tune failed to write the shape file.\n")
 
 
+# used for models exported without 'shape_profiles'
+DEFAULT_SHAPE_PROFILE = {
+    "min": [1, 3, 100, 100],
+    "opt": [1, 3, 512, 1024],
+    "max": [1, 3, 2000, 3000],
+}
+
+def merge_shape_profiles(profiles, batch_size):
+    """Combine 'profiles' into the single shape range Paddle's TensorRT
+    integration supports. The first profile provides the optimal shape.
+
+    Args:
+        profiles (list): Dicts with 'min', 'opt' and 'max' NCHW shapes
+        batch_size (int): Batch size the predictor will be run with
+    Returns:
+        (list, list, list): min, opt and max input shape
+    """
+    min_shape = [min(p['min'][i] for p in profiles) for i in range(4)]
+    max_shape = [max(p['max'][i] for p in profiles) for i in range(4)]
+    opt_shape = list(profiles[0]['opt'])
+    if max_shape[0] < batch_size:
+        logger.warning(f"Model was exported for batches of up to {max_shape[0]} images, but 'batch-size' is {batch_size}")
+        max_shape[0] = batch_size
+    opt_shape[0] = min(max(opt_shape[0], min_shape[0]), batch_size)
+    return min_shape, opt_shape, max_shape
+
+def mkldnn_cache_capacity(profiles):
+    """Number of input shapes MKLDNN should cache kernels for"""
+    if all(p['min'] == p['max'] for p in profiles):
+        # fixed shapes, plus the smaller last batch of each
+        return 2 * len(profiles)
+    return 10
+
+# names Paddle Inference saves the optimised program under ('enable_save_optim_model')
+OPTIMIZED_MODEL = "_optimized.pdmodel"
+OPTIMIZED_PARAMS = "_optimized.pdiparams"
+
+def optim_cache_key(args, cfg, trt_shapes=None, shape_file=None) -> str:
+    """Key of the optimised program (or TRT engines) for 'cfg' in 'optim-cache-dir'.
+    Covers everything which changes the result of the IR optimisation.
+
+    Paddle loads serialised TRT engines without checking the dynamic shape
+    range they were built for, so for TRT the key also covers the merged
+    shape profiles ('trt_shapes') and the auto tuned 'shape_file' in use.
+    """
+    k = [file_digest(cfg.model), file_digest(cfg.params), paddle_inference().get_version(), args.device]
+    if args.device == 'cpu':
+        k += [args.enable_mkldnn, args.cpu_threads]
+    else:
+        k += [args.use_trt, args.precision, args.min_subgraph_size, args.batch_size]
+        if args.use_trt:
+            k += [trt_shapes, file_digest(shape_file) if shape_file else None]
+    return hashlib.sha256(json.dumps(k).encode()).hexdigest()[:32]
+
 class DeployConfig:
     def __init__(self, path):
         with codecs.open(path, 'r', 'utf-8') as file:
             self.dic = yaml.load(file, Loader=yaml.FullLoader)
 
-        self._transforms = self.load_transforms(self.dic['Deploy'][
-            'transforms'])
+        t_list = self.dic['Deploy']['transforms']
+        # paddleseg's transforms are only built if they can't be compiled
+        self._fused = compile_transforms(t_list)
+        self._transforms = None if self._fused else self.load_transforms(copy.deepcopy(t_list))
         self._dir = os.path.dirname(path)
+        self._meta = None
 
     @property
     def transforms(self):
+        if self._transforms is None:
+            self._transforms = self.load_transforms(copy.deepcopy(self.dic['Deploy']['transforms']))
         return self._transforms
 
+    @property
+    def transforms_key(self) -> str:
+        """Identical for models which preprocess images the same way"""
+        return json.dumps(self.dic['Deploy']['transforms'], sort_keys=True)
+
+    def preprocess(self, img: np.ndarray) -> np.ndarray:
+        """Apply the model's transforms to the decoded (HWC, BGR, uint8) image
+        and return it as float32 CHW array"""
+        if self._fused:
+            return self._fused(img)
+        return self.transforms({"img": img.astype('float32')})["img"]
+
     @property
     def model(self):
         return os.path.join(self._dir, self.dic['Deploy']['model'])
@@ -131,8 +230,39 @@ class DeployConfig:
     def params(self):
         return os.path.join(self._dir, self.dic['Deploy']['params'])
 
+    @property
+    def precision(self):
+        """Precision the model was exported with ('int8' for quantized models)"""
+        return self.dic['Deploy'].get('precision', 'fp32')
+
+    @property
+    def shape_file(self):
+        """Auto tuned shape range info bundled with the model, if any"""
+        f = self.dic['Deploy'].get('shape_range_info')
+        return os.path.join(self._dir, f) if f else None
+
+    @property
+    def meta(self):
+        """Content of the 'meta.json' next to 'deploy.yaml' (empty if missing)"""
+        if self._meta is None:
+            path = os.path.join(self._dir, 'meta.json')
+            self._meta = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    self._meta = json.load(f)
+        return self._meta
+
+    @property
+    def shape_profiles(self):
+        """Input shape ranges the model was exported for (see 'export_model/export.py')"""
+        return self.meta.get('shape_profiles') or [DEFAULT_SHAPE_PROFILE]
+
     @staticmethod
     def load_transforms(t_list):
+        # importing any part of paddleseg imports (and registers) all of its
+        # models as well, which is why this is avoided where possible
+        import paddleseg.transforms as T
+        from paddleseg.cvlibs import manager
         com = manager.TRANSFORMS
         transforms = []
         for t in t_list:
@@ -142,14 +272,30 @@ class DeployConfig:
         return T.Compose(transforms)
 
 class Predictor:
-    def __init__(self, args: Dict, cfg: DeployConfig):
+    def __init__(self, args: Dict, cfg: DeployConfig, shape_file: Optional[str] = None):
         """
         Prepare for prediction.
         The usage and docs of paddle inference, please refer to
         https://paddleinference.paddlepaddle.org.cn/product_introduction/summary.html
+
+        'shape_file' is the auto tuned shape range info (see 'auto_tune') to
+        use for TRT instead of the model's shape profiles.
         """
         self.args = args
         self.cfg = cfg # DeployConfig(args.cfg)
+        # input batches are assembled in reused arrays, and shared with
+        # the predictor instead of copied where supported (CPU only)
+        self._buffers = BufferPool()
+        self._share_input = args.device == 'cpu'
+        self._shared = None
+        self._num_classes = len(cfg.meta.get('classes') or []) or 256
+        self._trt_shapes = None
+        if args.device == 'gpu' and args.use_trt:
+            self._trt_shapes = merge_shape_profiles(cfg.shape_profiles, args.batch_size)
+        if not (self._trt_shapes and use_auto_tune(args) and shape_file
+                and os.path.exists(shape_file)):
+            shape_file = None # only used for TRT
+        self.shape_file = shape_file
 
         self._init_base_config()
 
@@ -159,7 +305,8 @@ class Predictor:
             self._init_gpu_config()
 
         try:
-            self.predictor = create_predictor(self.pred_cfg)
+            self.predictor = paddle_inference().create_predictor(self.pred_cfg)
+            self._commit_optim_cache()
         except Exception as e:
             logger.info(str(e))
             logger.info(
@@ -188,11 +335,71 @@ class Predictor:
                 logger=logger)
 
     def _init_base_config(self):
-        self.pred_cfg = PredictConfig(self.cfg.model, self.cfg.params)
+        model, params = self.cfg.model, self.cfg.params
+        ir_optim = True
+        self._optim_dir = self._optim_save_dir = None
+        if getattr(self.args, 'optim_cache_dir', None):
+            model, params, ir_optim = self._init_optim_cache(model, params)
+        self.pred_cfg = paddle_inference().Config(model, params)
         if not self.args.print_detail:
             self.pred_cfg.disable_glog_info()
         self.pred_cfg.enable_memory_optim()
-        self.pred_cfg.switch_ir_optim(True)
+        self.pred_cfg.switch_ir_optim(ir_optim)
+        if self._optim_save_dir:
+            self.pred_cfg.set_optim_cache_dir(self._optim_save_dir)
+            if self._optim_save_dir != self._optim_dir:
+                self.pred_cfg.enable_save_optim_model(True)
+
+    def _init_optim_cache(self, model, params):
+        """Decide where to load the model from, and where to save the
+        optimised program to, when 'optim-cache-dir' is set.
+
+        TRT engines are serialised by Paddle into the cache directory
+        itself. Other optimised programs are saved into a temporary
+        directory first, which is moved into place once the predictor
+        has been created (see '_commit_optim_cache').
+        """
+        use_trt = self.args.device == 'gpu' and self.args.use_trt
+        use_mkldnn = self.args.device == 'cpu' and (self.args.enable_mkldnn or self.cfg.precision == 'int8')
+        if self.cfg.precision == 'int8' and not use_trt:
+            # the int8 passes can't be applied twice
+            logger.info("Optimised program cache is not supported for int8 models on CPU")
+            return model, params, True
+        if not use_trt and not hasattr(paddle_inference().Config, "enable_save_optim_model"):
+            logger.info("Paddle Inference can't save optimised programs - ignoring 'optim-cache-dir'")
+            return model, params, True
+
+        root = self.args.optim_cache_dir
+        os.makedirs(root, exist_ok=True)
+        self._optim_dir = os.path.join(root, optim_cache_key(self.args, self.cfg, self._trt_shapes, self.shape_file))
+        if use_trt:
+            os.makedirs(self._optim_dir, exist_ok=True)
+            self._optim_save_dir = self._optim_dir
+            return model, params, True
+
+        if os.path.exists(os.path.join(self._optim_dir, OPTIMIZED_PARAMS)):
+            logger.info(f"Loading optimised program from '{self._optim_dir}'")
+            os.utime(self._optim_dir)
+            model = os.path.join(self._optim_dir, OPTIMIZED_MODEL)
+            params = os.path.join(self._optim_dir, OPTIMIZED_PARAMS)
+            # the MKLDNN passes still need to place kernels, the generic fusions won't match again
+            return model, params, use_mkldnn
+        self._optim_save_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=root)
+        return model, params, True
+
+    def _commit_optim_cache(self):
+        tmp = self._optim_save_dir
+        if not tmp or tmp == self._optim_dir:
+            return
+        try:
+            if os.path.exists(os.path.join(tmp, OPTIMIZED_PARAMS)):
+                os.rename(tmp, self._optim_dir)
+                logger.info(f"Saved optimised program to '{self._optim_dir}'")
+        except OSError:
+            pass # another process got there first
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
 
     def _init_cpu_config(self):
         """
@@ -200,11 +407,18 @@ class Predictor:
         """
         logger.info("Use CPU")
         self.pred_cfg.disable_gpu()
-        if self.args.enable_mkldnn:
+        # quantized models are only fast with MKLDNN's int8 kernels
+        int8 = self.cfg.precision == 'int8'
+        if self.args.enable_mkldnn or int8:
             logger.info("Use MKLDNN")
-            # cache 10 different shapes for mkldnn
-            self.pred_cfg.set_mkldnn_cache_capacity(10)
+            self.pred_cfg.set_mkldnn_cache_capacity(mkldnn_cache_capacity(self.cfg.shape_profiles))
             self.pred_cfg.enable_mkldnn()
+            if int8:
+                if hasattr(self.pred_cfg, "enable_mkldnn_int8"):
+                    logger.info("Use MKLDNN int8")
+                    self.pred_cfg.enable_mkldnn_int8()
+                else:
+                    logger.warning("Paddle Inference lacks 'enable_mkldnn_int8' - running quantized model as is")
         self.pred_cfg.set_cpu_math_library_num_threads(self.args.cpu_threads)
 
     def _init_gpu_config(self):
@@ -213,38 +427,57 @@ class Predictor:
         """
         logger.info("Use GPU")
         self.pred_cfg.enable_use_gpu(100, 0)
+        PrecisionType = paddle_inference().PrecisionType
         precision_map = {
             "fp16": PrecisionType.Half,
             "fp32": PrecisionType.Float32,
             "int8": PrecisionType.Int8
         }
         precision_mode = precision_map[self.args.precision]
+        if self.cfg.precision == 'int8':
+            # the quantization scales are part of the model
+            precision_mode = PrecisionType.Int8
 
         if self.args.use_trt:
             logger.info("Use TRT")
+            min_shape, opt_shape, max_shape = self._trt_shapes
             self.pred_cfg.enable_tensorrt_engine(
                 workspace_size=1 << 30,
-                max_batch_size=1,
+                max_batch_size=max_shape[0],
                 min_subgraph_size=self.args.min_subgraph_size,
                 precision_mode=precision_mode,
-                use_static=False,
+                # serialise engines into 'optim-cache-dir', if set
+                use_static=self._optim_save_dir is not None,
                 use_calib_mode=False)
 
-            if use_auto_tune(self.args) and \
-                os.path.exists(self.args.auto_tuned_shape_file):
-                logger.info("Use auto tuned dynamic shape")
+            if self.shape_file:
+                logger.info(f"Use auto tuned dynamic shape from '{self.shape_file}'")
                 allow_build_at_runtime = True
                 self.pred_cfg.enable_tuned_tensorrt_dynamic_shape(
-                    self.args.auto_tuned_shape_file, allow_build_at_runtime)
+                    self.shape_file, allow_build_at_runtime)
             else:
-                logger.info("Use manual set dynamic shape")
-                min_input_shape = {"x": [1, 3, 100, 100]}
-                max_input_shape = {"x": [1, 3, 2000, 3000]}
-                opt_input_shape = {"x": [1, 3, 512, 1024]}
+                logger.info(f"Use dynamic shape of model (min: {min_shape}, opt: {opt_shape}, max: {max_shape})")
                 self.pred_cfg.set_trt_dynamic_shape_info(
-                    min_input_shape, max_input_shape, opt_input_shape)
+                    {"x": min_shape}, {"x": max_shape}, {"x": opt_shape})
 
     def run(self, io_manager):
+        """Run all images supplied by 'io_manager' through the model.
+
+        The work is split into three stages which run concurrently:
+        a pool of threads decoding and transforming images, the
+        inference itself (in the calling thread), and a pool of threads
+        encoding and delivering the results. The stages are connected
+        through bounded queues ('pipeline-depth') so the overall throughput
+        is limited by the slowest stage only.
+
+        Images of different sizes are grouped into shape buckets (see
+        'pad-multiple') and zero padded into a single tensor per batch. The
+        padding is cropped off again in '_postprocess'.
+
+        If 'tile-size' is set, images are instead split into overlapping
+        tiles which are batched independently of the image they belong to,
+        and the per-tile results are blended back into full resolution masks.
+        """
         input_names = self.predictor.get_input_names()
         input_handle = self.predictor.get_input_handle(input_names[0])
         output_names = self.predictor.get_output_names()
@@ -252,87 +485,204 @@ class Predictor:
         results = []
         args = self.args
 
-        first = True
-        for img_batch in io_manager:
-            # warm up
-            if first and args.benchmark:
-                for j in range(5):
-                    data = np.array([
-                        self._preprocess(img)
-                        for img in img_batch
-                    ])
-                    input_handle.reshape(data.shape)
-                    input_handle.copy_from_cpu(data)
-                    self.predictor.run()
-                    results = output_handle.copy_to_cpu()
-                    results = self._postprocess(results)
-            first = False
-
-            # inference
-            if args.benchmark:
-                self.autolog.times.start()
-
-            data = np.array([
-                self._preprocess(p) for p in img_batch
-            ])
-            input_handle.reshape(data.shape)
-            input_handle.copy_from_cpu(data)
-
-            if args.benchmark:
-                self.autolog.times.stamp()
-
-            self.predictor.run()
-
-            if args.benchmark:
-                self.autolog.times.stamp()
-
-            results = output_handle.copy_to_cpu()
-            results = self._postprocess(results)
-
-            if args.benchmark:
-                self.autolog.times.end(stamp=True)
-
-            io_manager.save_imgs(results, img_batch)
+        if getattr(io_manager, 'preprocessed', False):
+            # already preprocessed, e.g. shared between several models
+            samples = iter(io_manager)
+        else:
+            samples = imap_bounded(self._preprocess_sample, io_manager,
+                                   args.preprocess_workers, args.pipeline_depth * args.batch_size)
+        tiler = None
+        if args.tile_size:
+            tiler = Tiler(args.tile_size, args.tile_overlap, self._num_classes)
+            # tiles are at most 'tile-size' square, so all of them end up in one bucket
+            batches = bucket_batches(tiler.split(samples), args.batch_size, args.tile_size, self._buffers)
+        else:
+            batches = bucket_batches(samples, args.batch_size, args.pad_multiple, self._buffers)
+        with BoundedSink(io_manager.save_imgs, args.deliver_workers, args.pipeline_depth) as sink:
+            first = True
+            for batch in batches:
+                data = batch.data
+                # warm up
+                if first and args.benchmark:
+                    for j in range(5):
+                        self._set_input(input_handle, data)
+                        self.predictor.run()
+                        results = output_handle.copy_to_cpu()
+                        results = self._postprocess(results, batch.sizes)
+                first = False
+
+                # inference
+                if args.benchmark:
+                    # preprocessing happens concurrently in the decode pool,
+                    # so only the copy into the input tensor is timed here
+                    self.autolog.times.start()
+
+                self._set_input(input_handle, data)
+
+                if args.benchmark:
+                    self.autolog.times.stamp()
+
+                self.predictor.run()
+
+                if args.benchmark:
+                    self.autolog.times.stamp()
+
+                results = output_handle.copy_to_cpu()
+                startup.mark('first-inference')
+                if tiler:
+                    results, keys = tiler.merge(crop(results, batch.sizes), batch.keys)
+                else:
+                    results = self._postprocess(results, batch.sizes)
+                    keys = batch.keys
+
+                if args.benchmark:
+                    self.autolog.times.end(stamp=True)
+
+                if keys:
+                    sink.submit(results, keys)
         logger.info("Done")
 
+    def _set_input(self, handle, data: np.ndarray):
+        """Hand 'data' to the predictor, without a copy if possible.
+        'data' must stay untouched until the predictor has run."""
+        if self._share_input:
+            try:
+                from paddle.utils.dlpack import from_dlpack
+                # keep a reference, the predictor only holds a pointer
+                self._shared = from_dlpack(data.__dlpack__())
+                handle.share_external_data(self._shared)
+                return
+            except Exception as err:
+                logger.info(f"Sharing input data not supported ({err}) - copying instead")
+                self._share_input = False
+                self._shared = None
+        handle.reshape(data.shape)
+        handle.copy_from_cpu(data)
+
+    def _preprocess_sample(self, item):
+        key, img = item
+        return Sample(key, self._preprocess(img))
+
     def _preprocess(self, img):
-        logger.debug(f"... _preprocess {img}, self.cfg.transforms: {self.cfg.transforms}")
-        t = self.cfg.transforms({"img": img})
-        return t["img"]
+        logger.debug(f"... _preprocess {img.shape}")
+        return self.cfg.preprocess(img)
+
+    def _postprocess(self, results, sizes):
+        # models exported with argmax (the default) return (N, H, W) label
+        # maps, others (N, C, H, W) class scores
+        if results.ndim == 4:
+            results = argmax_labels(results)
+        elif results.dtype != np.uint8 and self._num_classes <= 256:
+            results = results.astype(np.uint8)
+        return crop(results, sizes)
+
+def argmax_labels(scores: np.ndarray) -> np.ndarray:
+    """argmax over the class axis of (N, C, H, W) scores, as uint8 label
+    map (int32 for more than 256 classes)"""
+    return np.argmax(scores, axis=1).astype(np.uint8 if scores.shape[1] <= 256 else np.int32)
+
+class PredictorPool:
+    """Keeps a small number of initialised 'Predictor's alive across orders,
+    so that only the first order for a model pays for creating the predictor
+    (IR optimisation, MKLDNN/TRT engine builds).
+
+    Predictors are keyed by model files, the content of the auto tuned shape
+    file, device configuration and whether they are benchmarked. The least
+    recently used predictor is dropped when there are more than
+    'max_predictors', or while the process uses more than 'max_rss' bytes
+    (0 means no limit). As the allocator
+    rarely hands memory back right away, the RSS is measured once and each
+    dropped predictor is assumed to free what the process grew by when it
+    was created.
+    """
+    def __init__(self, max_predictors: int = 1, max_rss: int = 0):
+        self.max_predictors = max(max_predictors, 1)
+        self.max_rss = max_rss
+        self._predictors = OrderedDict() # key -> (predictor, estimated size in bytes)
+
+    @staticmethod
+    def key(args, cfg: DeployConfig, shape_file: Optional[str] = None):
+        # without 'shape-cache-dir' the shape file is in the order's tmp dir
+        shapes = file_digest(shape_file) if shape_file else None
+        return (cfg.model, cfg.params, args.device, args.use_trt, args.precision,
+                args.min_subgraph_size, args.enable_auto_tune, shapes, args.cpu_threads,
+                args.enable_mkldnn, args.batch_size, args.print_detail,
+                # only predictors created for benchmarking have an 'autolog'
+                bool(getattr(args, 'benchmark', False)))
+
+    def get(self, args, cfg: DeployConfig, shape_file: Optional[str] = None) -> Predictor:
+        key = self.key(args, cfg, shape_file)
+        entry = self._predictors.pop(key, None)
+        if entry is None:
+            logger.info(f"Creating new predictor for '{cfg.model}'")
+            rss = rss_bytes()
+            predictor = Predictor(args, cfg, shape_file)
+            entry = (predictor, max(rss_bytes() - rss, 0))
+        else:
+            logger.info(f"Reusing predictor for '{cfg.model}'")
+            predictor = entry[0]
+            predictor.args = args
+            predictor.cfg = cfg
+        self._predictors[key] = entry
+        self.evict()
+        return predictor
+
+    def evict(self):
+        while len(self._predictors) > self.max_predictors:
+            self._drop_oldest()
+        if self.max_rss <= 0:
+            return
+        rss = rss_bytes()
+        while len(self._predictors) > 1 and rss > self.max_rss:
+            rss -= self._drop_oldest()
+
+    def _drop_oldest(self) -> int:
+        """Drop the least recently used predictor and return its estimated size"""
+        key, (_, size) = self._predictors.popitem(last=False)
+        logger.info(f"Evicting predictor for '{key[0]}' (~{size >> 20} MiB)")
+        gc.collect()
+        return size
 
-    def _postprocess(self, results):
-        if self.args.with_argmax:
-            results = np.argmax(results, axis=1)
-        return results
+    def __len__(self):
+        return len(self._predictors)
 
 ######
 #
 # Utility function
 
-def adjust_image(image, max_size):
-    """Ensures that image is of max size if defined in --max-size
+def decode_image(imgPath, max_size):
+    """Decodes the image file 'imgPath', downscaling it to at most 'max_size' pixels
+
+    The image is decoded in memory into the same layout 'cv2.imread' would
+    produce (HWC, BGR, EXIF orientation applied) so it can be handed straight
+    to the 'DeployConfig.transforms'. JPEGs which need to be reduced a lot
+    are decoded at a lower resolution in the DCT domain ('draft' mode) before
+    the final resize.
 
     Args:
-        path (str): File name of image
+        imgPath (str): File name of image
+        max_size (int): Max number of pixels, or -1 to keep the image's size
+    Returns:
+        np.ndarray: The decoded image (uint8)
     """
-    imgPath = image.as_local_file()
-    logger.info(f"Checking if image '{image.name}' needs adjusting (max-size: {max_size})")
-    if max_size < 0:
-        # keep image
-        return imgPath
-
     img = Image.open(imgPath)
-    format = img.format
     width, height = img.size
     size = width * height
-    if size > max_size:
+    if max_size >= 0 and size > max_size:
         # too big
         scale = math.sqrt(max_size / size)
         w = int(scale * width)
         h = int(scale * height)
         logger.info(f"Downscaling image by '{scale}' ({w}x{h})")
-        img = img.resize((w,h))
-        imgf = tempfile.NamedTemporaryFile("w+b", delete=False)
-        img.save(imgf, format)
-        imgPath = imgf.name
-    return imgPath
\ No newline at end of file
+        if img.format == 'JPEG':
+            # let the decoder skip detail we are going to throw away anyway
+            img.draft('RGB', (w, h))
+        img = img.resize((w, h))
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    # RGB -> BGR
+    return np.ascontiguousarray(np.asarray(img)[:, :, ::-1])
+
+def rss_bytes() -> int:
+    """Return the resident set size of this process"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
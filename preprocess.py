@@ -0,0 +1,150 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compiles the 'Deploy.transforms' of a 'deploy.yaml' into a single routine
+# which resizes the uint8 image and then normalises, converts to RGB and
+# transposes to CHW in one pass per channel. This replaces paddleseg's
+# 'Compose', which converts the whole image to float32 first and copies it
+# again for every transform. Transform lists using anything else are left
+# to paddleseg (see 'compile_transforms').
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+INTERPOLATIONS = ['NEAREST', 'LINEAR', 'CUBIC', 'AREA', 'LANCZOS4']
+
+def _interp(name: str) -> int:
+    import cv2
+    return getattr(cv2, f"INTER_{name}")
+
+def _resize(img: np.ndarray, w: int, h: int, interp: str) -> np.ndarray:
+    import cv2
+    if (h, w) == img.shape[:2]:
+        return img
+    return cv2.resize(img, (w, h), interpolation=_interp(interp))
+
+def _scaled(img: np.ndarray, scale: float) -> Tuple[int, int]:
+    return int(round(img.shape[1] * scale)), int(round(img.shape[0] * scale))
+
+def _resize_op(kind: str, t: Dict[str, Any]) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+    """Return a function implementing the paddleseg resize transform 't',
+    or None if it can't be compiled"""
+    if kind == 'Resize':
+        target = t.get('target_size', (512, 512))
+        interp = t.get('interp', 'LINEAR')
+        divisor = t.get('size_divisor')
+        if t.get('keep_ratio') or interp not in INTERPOLATIONS:
+            return None
+        w, h = target
+        if divisor:
+            w, h = [-(-v // divisor) * divisor for v in (w, h)]
+        return lambda img: _resize(img, w, h, interp)
+    if kind == 'ResizeByLong':
+        size = t['long_size']
+        return lambda img: _resize(img, *_scaled(img, size / max(img.shape[:2])), 'LINEAR')
+    if kind == 'ResizeByShort':
+        size = t['short_size']
+        if isinstance(size, list) or 'max_size' in t:
+            return None
+        return lambda img: _resize(img, *_scaled(img, size / min(img.shape[:2])), 'LINEAR')
+    return None
+
+def _channels(v) -> np.ndarray:
+    v = np.asarray(v, dtype=np.float64).reshape(-1)
+    return np.broadcast_to(v, (3,)) if v.size == 1 else v
+
+class FusedTransforms:
+    """Preprocessing equivalent to a paddleseg 'Compose' of resizes,
+    'Normalize' and 'Padding'.
+
+    Resizes are applied to the uint8 image, which for the (linear)
+    interpolations used gives the same result as resizing after normalising
+    up to float rounding. Each output channel is then computed with a single
+    multiply-add straight into the CHW result.
+    """
+    def __init__(self, resizes: List[Callable], mean, std, pad_size: Optional[Tuple[int, int]],
+                 pad_value, to_rgb: bool = True):
+        self.resizes = resizes
+        # (x / 255 - mean) / std == x * scale - offset
+        self.scale = (1.0 / (255.0 * std)).astype(np.float32)
+        self.offset = (mean / std).astype(np.float32)
+        self.pad_size = pad_size    # (w, h)
+        self.pad_value = pad_value  # per channel, in the output's value range
+        self.to_rgb = to_rgb
+
+    def _padded(self, h: int, w: int) -> Tuple[int, int]:
+        if self.pad_size is None:
+            return h, w
+        pw, ph = self.pad_size
+        if h > ph or w > pw:
+            raise ValueError(f"The size of image should be less than `target_size`, but the size of image "
+                             f"({w}, {h}) is larger than `target_size` ({pw}, {ph})")
+        return ph, pw
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        """Transform the HWC, BGR, uint8 image 'img' (as returned by
+        'decode_image') into a float32 CHW array"""
+        for r in self.resizes:
+            img = r(img)
+        h, w = img.shape[:2]
+        ph, pw = self._padded(h, w)
+        out = np.empty((3, ph, pw), dtype=np.float32)
+        for c in range(3):
+            src = img[:, :, 2 - c] if self.to_rgb else img[:, :, c]
+            dst = out[c, :h, :w]
+            np.multiply(src, self.scale[c], out=dst)
+            dst -= self.offset[c]
+            if (ph, pw) != (h, w):
+                out[c, h:ph, :pw] = self.pad_value[c]
+                out[c, :h, w:pw] = self.pad_value[c]
+        return out
+
+def compile_transforms(t_list: List[Dict[str, Any]], to_rgb: bool = True) -> Optional[FusedTransforms]:
+    """Compile the 'Deploy.transforms' list of a 'deploy.yaml', or return
+    None if it contains transforms (or orderings) which aren't supported"""
+    resizes = []
+    mean, std = None, None
+    pad = None # (target size, value, normalised)
+    for t in t_list:
+        kind = t.get('type')
+        if kind in ('Resize', 'ResizeByLong', 'ResizeByShort'):
+            op = _resize_op(kind, t)
+            if op is None or pad is not None:
+                # can't resize padding into the image
+                return None
+            resizes.append(op)
+        elif kind == 'Normalize':
+            if mean is not None:
+                return None
+            mean, std = _channels(t.get('mean', (0.5,))), _channels(t.get('std', (0.5,)))
+        elif kind == 'Padding':
+            if pad is not None:
+                return None
+            size = t['target_size']
+            size = (size, size) if isinstance(size, int) else tuple(size)
+            pad = (size, t.get('im_padding_value', 127.5), mean is not None)
+        else:
+            return None
+
+    if mean is None:
+        # no normalisation, plain float32 values in [0, 255]
+        mean, std = np.zeros(3), np.full(3, 1 / 255.0)
+    pad_size, pad_value = None, None
+    if pad is not None:
+        pad_size, value, normalised = pad
+        value = _channels(value)
+        # padding before 'Normalize' gets normalised along with the image
+        pad_value = (value if normalised else (value / 255.0 - mean) / std).astype(np.float32)
+    return FusedTransforms(resizes, mean, std, pad_size, pad_value, to_rgb)
@@ -0,0 +1,103 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# On-disk cache of label maps, so that images which have already been run
+# through the same model (with the same preprocessing) are not inferred again.
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+class ResultCache:
+    """Stores label maps in 'root' keyed by model, preprocessing parameters
+    and image content. Once the cache grows beyond 'max_bytes', the least
+    recently used entries are removed until it is back to 90% of that.
+
+    Entries are written to a temporary file first and renamed into place,
+    so several processes may share 'root'.
+    """
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(os.path.getsize(p) for p in self._entries())
+
+    @staticmethod
+    def key(model_digest: str, params: Dict[str, Any], image_digest: str) -> str:
+        k = json.dumps([model_digest, params, image_digest], sort_keys=True)
+        return hashlib.sha256(k.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.npy")
+
+    def _entries(self):
+        for dir, _, files in os.walk(self.root):
+            for f in files:
+                if f.endswith(".npy"):
+                    yield os.path.join(dir, f)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the label map stored under 'key', or None"""
+        path = self._path(key)
+        try:
+            label = np.load(path)
+            os.utime(path)
+            return label
+        except (OSError, ValueError):
+            # missing, evicted by someone else, or partially written by an older version
+            return None
+
+    def put(self, key: str, label: np.ndarray):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, label.astype(np.uint8, copy=False) if label.max(initial=0) < 256 else label)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            self._size += os.path.getsize(path)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        with open(os.path.join(self.root, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for p in self._entries():
+                try:
+                    st = os.stat(p)
+                    entries.append((st.st_mtime, st.st_size, p))
+                except OSError:
+                    pass # removed by another process
+            self._size = sum(e[1] for e in entries)
+            target = 0.9 * self.max_bytes
+            for _, size, p in sorted(entries):
+                if self._size <= target:
+                    break
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+                self._size -= size
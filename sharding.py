@@ -0,0 +1,213 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Multi-process CPU inference. Paddle's intra-op threading stops scaling long
+# before a large node is saturated, so instead we start several predictor
+# processes, each pinned to its own set of cores, and shard the image stream
+# across them. All results are delivered by the parent process.
+
+from collections import namedtuple
+import glob
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import traceback
+from typing import Any, Dict, List, Set
+
+from pipeline import BoundedSink
+import startup
+
+logger = None # set when called by SDK
+
+def set_logger(l: logging):
+    global logger
+    logger = l
+
+def parse_cpulist(s: str) -> List[int]:
+    """Parse a kernel cpu list such as '0-3,8-11'"""
+    cpus = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def numa_nodes(available: Set[int]) -> List[List[int]]:
+    """Return the cores in 'available' grouped by NUMA node"""
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cpus = [c for c in parse_cpulist(f.read()) if c in available]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(available)]
+
+def core_sets(workers: int) -> List[List[int]]:
+    """Split the cores this process may run on into 'workers' sets.
+
+    Cores are taken NUMA node by NUMA node, so that a set only spans
+    nodes if a node has to be shared between several workers.
+    """
+    cores = [c for node in numa_nodes(os.sched_getaffinity(0)) for c in node]
+    workers = max(min(workers, len(cores)), 1)
+    per_worker, extra = divmod(len(cores), workers)
+    sets = []
+    start = 0
+    for i in range(workers):
+        n = per_worker + (1 if i < extra else 0)
+        sets.append(cores[start:start + n])
+        start += n
+    return sets
+
+# how often the parent checks that its workers are still alive
+POLL_SECS = 1.0
+
+_DONE = "done"
+_RESULT = "result"
+_ERROR = "error"
+
+class _QueueIO:
+    """Takes the place of the 'IOManager' inside a worker process"""
+    def __init__(self, tasks, results, preprocessed: bool):
+        self.tasks = tasks
+        self.results = results
+        self.preprocessed = preprocessed
+
+    def __iter__(self):
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                return
+            yield item
+
+    def save_imgs(self, results, keys):
+        # a batch which needed no cropping stays one array (see 'batching.crop')
+        self.results.put((_RESULT, results if hasattr(results, "shape") else list(results), list(keys)))
+
+def _worker_main(idx: int, cores: List[int], args: Dict[str, Any], model_dir: str, preprocessed: bool, tasks, results):
+    try:
+        os.sched_setaffinity(0, cores)
+        os.environ["OMP_NUM_THREADS"] = str(len(cores))
+        logging.basicConfig(level=logging.INFO)
+        wlogger = logging.getLogger(f"shard-{idx}")
+
+        import predictor # deferred until the affinity and thread count are set
+        predictor.set_logger(wlogger)
+        ST = namedtuple('ServiceArgs', args.keys())
+        pargs = ST(**args)
+        cfg = predictor.DeployConfig(os.path.join(model_dir, 'deploy.yaml'))
+        p = predictor.Predictor(pargs, cfg)
+        wlogger.info(f"Worker {idx} running on cores {cores}")
+        p.run(_QueueIO(tasks, results, preprocessed))
+        if pargs.benchmark:
+            p.autolog.report()
+        results.put((_DONE, idx, None))
+    except BaseException:
+        results.put((_ERROR, idx, traceback.format_exc()))
+
+class ShardedPredictor:
+    """Runs 'workers' CPU predictor processes side by side.
+
+    Images are handed out through a shared queue, so faster workers simply
+    take more of them. Each worker uses as many intra-op threads as it has
+    cores ('cpu-threads' is ignored).
+    """
+    def __init__(self, args, model_dir: str, workers: int):
+        self.args = args
+        self.model_dir = model_dir
+        self.core_sets = core_sets(workers)
+
+    def _worker_args(self, cores: List[int]) -> Dict[str, Any]:
+        a = {k: v for k, v in self.args._asdict().items() if k not in ('model', 'extra_models', 'images')}
+        a['cpu_threads'] = len(cores)
+        a['deliver_workers'] = 1
+        return a
+
+    def run(self, io_manager):
+        ctx = mp.get_context("spawn")
+        n = len(self.core_sets)
+        tasks = ctx.Queue(maxsize=max(self.args.pipeline_depth * self.args.batch_size, 1) * n)
+        results = ctx.Queue()
+        preprocessed = getattr(io_manager, 'preprocessed', False)
+        procs = [ctx.Process(target=_worker_main, name=f"shard-{i}", daemon=True,
+                             args=(i, cores, self._worker_args(cores), self.model_dir, preprocessed, tasks, results))
+                 for i, cores in enumerate(self.core_sets)]
+        for p in procs:
+            p.start()
+        logger.info(f"Started {n} predictor processes on core sets {self.core_sets}")
+
+        feed_error = []
+        stop = threading.Event()
+        def put(item) -> bool:
+            # gives up once the workers are gone, which would otherwise block forever
+            while not stop.is_set():
+                try:
+                    tasks.put(item, timeout=POLL_SECS)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        def feed():
+            try:
+                for item in io_manager:
+                    if not put(item):
+                        return
+            except BaseException as err:
+                feed_error.append(err)
+            finally:
+                for _ in procs:
+                    if not put(None):
+                        break
+        feeder = threading.Thread(target=feed, name="shard-feeder", daemon=True)
+        feeder.start()
+
+        try:
+            with BoundedSink(io_manager.save_imgs, self.args.deliver_workers, self.args.pipeline_depth) as sink:
+                done = set()
+                while len(done) < n:
+                    try:
+                        kind, a, b = results.get(timeout=POLL_SECS)
+                    except queue.Empty:
+                        self._check_alive(procs, done, results)
+                        continue
+                    if kind == _RESULT:
+                        startup.mark('first-inference')
+                        sink.submit(a, b)
+                    elif kind == _DONE:
+                        done.add(a)
+                    else:
+                        raise Exception(f"predictor process {a} failed:\n{b}")
+            feeder.join()
+            if feed_error:
+                raise feed_error[0]
+        finally:
+            stop.set()
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+        logger.info("Done")
+
+    @staticmethod
+    def _check_alive(procs, done: Set[int], results):
+        """Raise if a worker died (e.g. segfault, OOM killer) without reporting"""
+        for i, p in enumerate(procs):
+            if i not in done and p.exitcode is not None and results.empty():
+                raise Exception(f"predictor process {i} exited with code {p.exitcode} without reporting")
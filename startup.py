@@ -0,0 +1,88 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Records how long it takes an order to get going: importing the service,
+# loading the model, importing paddle, building the predictor and running
+# the first inference. As every IVCAP order runs in a fresh process, these
+# add up to the cold start of the service.
+
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+_LOADED = time.perf_counter()
+
+def process_age() -> float:
+    """Seconds since this process was started"""
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the (parenthesised) command start with field 3, 'starttime' is field 22
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - _LOADED
+
+class StartupTimer:
+    """Milestones of an order, in seconds since the order started.
+    Only the first time each milestone is reached is recorded."""
+    def __init__(self, imported: Optional[float] = None):
+        self.start = time.perf_counter()
+        self.imported = imported # process start to service imported, if this is the first order
+        self.milestones: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def mark(self, name: str):
+        with self._lock:
+            if all(n != name for n, _ in self.milestones):
+                self.milestones.append((name, time.perf_counter() - self.start))
+
+    def report(self) -> str:
+        parts = []
+        if self.imported is not None:
+            parts.append(f"import {self.imported:.2f}s")
+        last = 0.0
+        for name, t in self.milestones:
+            parts.append(f"{name} {t - last:.2f}s")
+            last = t
+        if not parts:
+            return "Startup: no milestones reached"
+        total = last + (self.imported or 0.0)
+        return f"Startup: {', '.join(parts)} (total {total:.2f}s)"
+
+_imported = None
+_import_reported = False
+_current = None
+
+def imported():
+    """Called once the service's modules have been imported"""
+    global _imported
+    if _imported is None:
+        _imported = process_age()
+
+def begin() -> StartupTimer:
+    """Start timing a new order. The import time is only reported for
+    the first order of the process."""
+    global _import_reported, _current
+    _current = StartupTimer(None if _import_reported else _imported)
+    _import_reported = True
+    return _current
+
+def mark(name: str):
+    """Record milestone 'name' of the current order (if any)"""
+    t = _current
+    if t is not None:
+        t.mark(name)
@@ -0,0 +1,88 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the shape bucketing, padding and cropping in 'batching'.
+
+import numpy as np
+
+from batching import BufferPool, Sample, bucket_batches, class_histograms, crop, padded_shape, stack
+
+def sample(key, h, w, value=1.0):
+    return Sample(key, np.full((3, h, w), value, dtype=np.float32))
+
+def test_padded_shape():
+    assert padded_shape(100, 65, 32) == (128, 96)
+    assert padded_shape(64, 64, 32) == (64, 64)
+    assert padded_shape(100, 65, 1) == (100, 65)
+
+def test_stack_zero_pads():
+    data = stack([sample('a', 2, 3), sample('b', 4, 1)], (4, 4))
+    assert data.shape == (2, 3, 4, 4)
+    assert data[0, :, :2, :3].all() and not data[0, :, 2:].any() and not data[0, :, :, 3:].any()
+    assert data[1, :, :, :1].all() and not data[1, :, :, 1:].any()
+
+def test_stack_clears_padding_of_reused_buffer():
+    pool = BufferPool()
+    first = stack([sample('a', 4, 4, 7.0)], (4, 4), pool)
+    second = stack([sample('b', 2, 2)], (4, 4), pool)
+    assert second is first
+    expected = np.zeros((1, 3, 4, 4), dtype=np.float32)
+    expected[0, :, :2, :2] = 1.0
+    np.testing.assert_array_equal(second, expected)
+
+def test_crop_removes_padding():
+    results = np.arange(2 * 4 * 4).reshape(2, 4, 4)
+    cropped = crop(results, [(2, 3), (4, 4)])
+    assert [r.shape for r in cropped] == [(2, 3), (4, 4)]
+    np.testing.assert_array_equal(cropped[0], results[0, :2, :3])
+    # logits keep their class axis
+    logits = np.zeros((2, 5, 4, 4))
+    assert [r.shape for r in crop(logits, [(2, 3), (4, 1)])] == [(5, 2, 3), (5, 4, 1)]
+
+def test_crop_keeps_unpadded_batch_as_array():
+    results = np.zeros((2, 4, 4))
+    assert crop(results, [(4, 4), (4, 4)]) is results
+
+def test_batches_group_by_padded_shape():
+    samples = [sample(0, 30, 30), sample(1, 60, 60), sample(2, 31, 20), sample(3, 64, 50)]
+    batches = list(bucket_batches(samples, batch_size=2, pad_multiple=32))
+    assert [(b.keys, b.data.shape) for b in batches] == [
+        ([0, 2], (2, 3, 32, 32)),
+        ([1, 3], (2, 3, 64, 64)),
+    ]
+    assert batches[0].sizes == [(30, 30), (31, 20)]
+
+def test_single_image_batches_are_not_padded():
+    batches = list(bucket_batches([sample(0, 30, 50), sample(1, 33, 33)], batch_size=1, pad_multiple=32))
+    assert [b.data.shape for b in batches] == [(1, 3, 30, 50), (1, 3, 33, 33)]
+    assert crop(np.zeros((1, 30, 50)), batches[0].sizes).shape == (1, 30, 50)
+
+def test_class_histograms_of_batch_array():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, size=(3, 5, 6)).astype(np.uint8)
+    hists = class_histograms(labels, 4)
+    assert hists.shape == (3, 4)
+    for i in range(3):
+        np.testing.assert_array_equal(hists[i], np.bincount(labels[i].ravel(), minlength=4))
+
+def test_class_histograms_of_cropped_results():
+    labels = np.zeros((2, 4, 4), dtype=np.uint8)
+    labels[0, :2, :2] = 1
+    labels[1, 3, :] = 2 # padding, cropped off below
+    hists = class_histograms(crop(labels, [(4, 4), (3, 4)]), 3)
+    np.testing.assert_array_equal(hists, [[12, 4, 0], [12, 0, 0]])
+
+def test_class_histograms_ignore_unknown_labels():
+    labels = np.array([[[0, 1, 255]], [[1, 1, 0]]], dtype=np.uint8)
+    np.testing.assert_array_equal(class_histograms(labels, 2), [[1, 1], [1, 2]])
@@ -0,0 +1,130 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of 'delivery.Deliverer' against a local stand-in for 'deliver_data'.
+
+import io
+import logging
+import threading
+import time
+
+import pytest
+
+import delivery
+from delivery import Deliverer
+
+delivery.set_logger(logging.getLogger("test_delivery"))
+
+class StubStorage:
+    """Stands in for 'deliver_data': stores what is written, failing the
+    first 'failures' attempts of every artifact. If 'gate' is set, uploads
+    wait for it."""
+    def __init__(self, failures: int = 0, gate: threading.Event = None):
+        self.failures = failures
+        self.gate = gate
+        self.attempts = {}
+        self.stored = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, name, write, mime_type, metadata=None):
+        with self._lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            attempt = self.attempts[name]
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.gate is not None:
+                self.gate.wait(5)
+            if attempt <= self.failures:
+                raise IOError(f"upload of '{name}' failed")
+            buf = io.BytesIO()
+            write(buf)
+            self.stored[name] = (buf.getvalue(), mime_type, metadata)
+            return f"urn:test:{name}"
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the backoff delays instead of sleeping"""
+    delays = []
+    monkeypatch.setattr(delivery.time, "sleep", delays.append)
+    return delays
+
+def test_delivers_all(sleeps):
+    storage = StubStorage()
+    d = Deliverer(storage, max_in_flight=4)
+    for i in range(20):
+        d.submit(f"img-{i}.png", b"x" * i, "image/png", metadata={"i": i})
+    d.close()
+    assert len(storage.stored) == 20
+    assert storage.stored["img-7.png"] == (b"x" * 7, "image/png", {"i": 7})
+    assert sleeps == []
+
+def test_retries_with_exponential_backoff(sleeps):
+    storage = StubStorage(failures=2)
+    d = Deliverer(storage, retries=3, backoff=0.5)
+    d.submit("a.png", b"data", "image/png")
+    d.close()
+    assert storage.attempts["a.png"] == 3
+    assert storage.stored["a.png"][0] == b"data"
+    # 0.5s, then 1s, each with +-50% jitter
+    assert len(sleeps) == 2
+    assert 0.25 <= sleeps[0] < 0.75
+    assert 0.5 <= sleeps[1] < 1.5
+
+def test_flush_raises_once_retries_are_exhausted(sleeps):
+    storage = StubStorage(failures=10)
+    d = Deliverer(storage, retries=2, backoff=0.1)
+    d.submit("a.png", b"data", "image/png")
+    with pytest.raises(IOError, match="upload of 'a.png' failed"):
+        d.flush()
+    assert storage.attempts["a.png"] == 3
+    assert "a.png" not in storage.stored
+    # the error is also raised on later submits
+    with pytest.raises(IOError):
+        d.submit("b.png", b"data", "image/png")
+    with pytest.raises(IOError):
+        d.close()
+
+def test_bounds_uploads_in_flight():
+    gate = threading.Event()
+    storage = StubStorage(gate=gate)
+    d = Deliverer(storage, max_in_flight=3)
+    submitted = []
+
+    def submit_all():
+        for i in range(10):
+            d.submit(f"img-{i}.png", b"x", "image/png")
+            submitted.append(i)
+    t = threading.Thread(target=submit_all, daemon=True)
+    t.start()
+
+    # 'submit' blocks once 3 uploads are outstanding
+    deadline = time.time() + 5
+    while storage.in_flight < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert storage.in_flight == 3
+    assert len(submitted) == 3
+
+    gate.set()
+    t.join(5)
+    d.close()
+    assert len(submitted) == 10
+    assert len(storage.stored) == 10
+    assert storage.max_in_flight == 3
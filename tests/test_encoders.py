@@ -0,0 +1,68 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the mask encoders in 'encoders'.
+
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from encoders import encode_mask, rle_counts
+
+def decode_rle(counts, size):
+    """Inverse of 'rle_counts'"""
+    flat = np.zeros(size, dtype=bool)
+    pos, value = 0, False
+    for n in counts:
+        flat[pos:pos + n] = value
+        pos += n
+        value = not value
+    return flat
+
+def test_rle_counts_start_with_zeros():
+    assert rle_counts(np.array([0, 0, 1, 1, 1, 0], dtype=bool)) == [2, 3, 1]
+    assert rle_counts(np.array([1, 1, 0], dtype=bool)) == [0, 2, 1]
+    assert rle_counts(np.array([1], dtype=bool)) == [0, 1]
+
+def test_rle_counts_round_trip():
+    rng = np.random.default_rng(0)
+    mask = rng.random(1000) > 0.7
+    counts = rle_counts(mask)
+    assert sum(counts) == mask.size
+    np.testing.assert_array_equal(decode_rle(counts, mask.size), mask)
+
+def test_rle_json_is_column_major():
+    label = np.array([[0, 1, 1], [2, 1, 0]], dtype=np.uint8)
+    enc = encode_mask(label, 'rle-json', classes=[{'id': 'a'}, {'id': 'b'}])
+    doc = json.loads(enc.data)
+    assert doc['size'] == [2, 3]
+    masks = {m['label']: m for m in doc['masks']}
+    assert sorted(masks) == [0, 1, 2]
+    assert masks[1]['id'] == 'b' and 'id' not in masks[2]
+    for c, m in masks.items():
+        flat = decode_rle(m['counts'], label.size)
+        np.testing.assert_array_equal(flat.reshape(label.shape, order='F'), label == c)
+
+def test_npy_and_png_keep_labels():
+    label = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    np.testing.assert_array_equal(np.load(io.BytesIO(encode_mask(label, 'npy').data)), label)
+    png = encode_mask(label, 'pseudo-png', palette=bytes(range(256)) * 3)
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(png.data))), label)
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        encode_mask(np.zeros((2, 2), dtype=np.uint8), 'tiff')
@@ -0,0 +1,136 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the concurrent building blocks in 'pipeline'.
+
+import threading
+import time
+
+import pytest
+
+from pipeline import BoundedSink, fan_out, imap_bounded, prefetch
+
+def test_imap_bounded_keeps_order():
+    def slow_square(i):
+        time.sleep(0.001 * (i % 3))
+        return i * i
+    assert list(imap_bounded(slow_square, range(50), workers=4, depth=8)) == [i * i for i in range(50)]
+
+def test_imap_bounded_applies_backpressure():
+    consumed = []
+    started = []
+    def fn(i):
+        started.append(i)
+        return i
+    for i in imap_bounded(fn, range(100), workers=2, depth=4):
+        # never more than 'depth' elements ahead of the consumer
+        assert len(started) <= len(consumed) + 4 + 1
+        consumed.append(i)
+    assert consumed == list(range(100))
+
+def test_imap_bounded_stays_within_budget():
+    pulled = []
+    def items():
+        for i in range(20):
+            time.sleep(0.005) # lets the previous element finish
+            pulled.append(i)
+            yield i
+    consumed = 0
+    for _ in imap_bounded(lambda i: i, items(), workers=4, depth=8, budget=10, cost=lambda r: 6):
+        # two finished results exceed the budget, plus the one just submitted
+        assert len(pulled) <= consumed + 3
+        consumed += 1
+    assert consumed == 20
+
+def test_imap_bounded_raises_in_consumer():
+    def fn(i):
+        if i == 5:
+            raise ValueError("bad element")
+        return i
+    out = []
+    with pytest.raises(ValueError, match="bad element"):
+        for i in imap_bounded(fn, range(10), workers=2, depth=2):
+            out.append(i)
+    assert out == [0, 1, 2, 3, 4]
+
+def test_bounded_sink_reraises_worker_error():
+    done = []
+    def fn(i):
+        if i == 3:
+            raise KeyError(i)
+        done.append(i)
+    with pytest.raises(KeyError):
+        with BoundedSink(fn, workers=2, depth=2) as sink:
+            for i in range(10):
+                sink.submit(i)
+
+def test_bounded_sink_limits_outstanding_work():
+    gate = threading.Event()
+    running = []
+    sink = BoundedSink(lambda i: (running.append(i), gate.wait(5)), workers=1, depth=2)
+    submitted = []
+    def submit_all():
+        for i in range(5):
+            sink.submit(i)
+            submitted.append(i)
+    t = threading.Thread(target=submit_all, daemon=True)
+    t.start()
+    time.sleep(0.1)
+    assert len(submitted) <= 2
+    gate.set()
+    t.join(5)
+    sink.close()
+    assert sorted(running) == list(range(5))
+
+def test_prefetch_reraises_producer_error():
+    def items():
+        yield 1
+        yield 2
+        raise RuntimeError("source failed")
+    out = []
+    with pytest.raises(RuntimeError, match="source failed"):
+        for i in prefetch(items(), depth=2):
+            out.append(i)
+    assert out == [1, 2]
+
+def test_fan_out_delivers_everything_to_every_consumer():
+    branches = fan_out(range(100), 3, depth=4)
+    results = [[] for _ in branches]
+    threads = [threading.Thread(target=lambda b=b, r=r: r.extend(b)) for b, r in zip(branches, results)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert results == [list(range(100))] * 3
+
+def test_fan_out_cancel_stops_all_consumers():
+    cancel = threading.Event()
+    def endless():
+        i = 0
+        while True:
+            yield i
+            i += 1
+    branches = fan_out(endless(), 2, depth=2, cancel=cancel)
+    seen = [0, 0]
+    def consume(i):
+        for _ in branches[i]:
+            seen[i] += 1
+            if i == 0 and seen[i] == 10:
+                cancel.set()
+    threads = [threading.Thread(target=consume, args=(i,), daemon=True) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert not any(t.is_alive() for t in threads)
@@ -0,0 +1,38 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the parts of 'predictor' which don't need Paddle.
+
+import numpy as np
+
+from predictor import argmax_labels
+
+def test_argmax_labels_matches_numpy():
+    rng = np.random.default_rng(0)
+    scores = rng.integers(0, 3, size=(2, 5, 7, 9)).astype(np.float32) # plenty of ties
+    labels = argmax_labels(scores)
+    assert labels.dtype == np.uint8
+    np.testing.assert_array_equal(labels, np.argmax(scores, axis=1))
+
+def test_argmax_labels_of_single_class():
+    labels = argmax_labels(np.random.rand(1, 1, 4, 4).astype(np.float32))
+    assert labels.dtype == np.uint8
+    assert labels.shape == (1, 4, 4) and not labels.any()
+
+def test_argmax_labels_of_many_classes():
+    scores = np.zeros((1, 300, 2, 2), dtype=np.float32)
+    scores[0, 299, 1, 1] = 1
+    labels = argmax_labels(scores)
+    assert labels.dtype == np.int32
+    assert labels[0, 1, 1] == 299 and labels.sum() == 299
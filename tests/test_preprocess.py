@@ -0,0 +1,77 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of the compiled 'deploy.yaml' transforms in 'preprocess', against
+# what paddleseg's 'Compose' computes.
+
+import numpy as np
+import pytest
+
+from preprocess import compile_transforms
+
+def image(h=6, w=5):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8) # BGR
+
+def reference(img, mean, std):
+    """paddleseg's 'Compose' + 'Normalize': RGB, CHW, (x / 255 - mean) / std"""
+    rgb = img[:, :, ::-1].astype(np.float32)
+    out = (rgb / 255.0 - np.asarray(mean, np.float32)) / np.asarray(std, np.float32)
+    return out.transpose(2, 0, 1)
+
+def test_normalize():
+    t = compile_transforms([{'type': 'Normalize', 'mean': [0.4, 0.5, 0.6], 'std': [0.2, 0.3, 0.4]}])
+    img = image()
+    out = t(img)
+    assert out.dtype == np.float32 and out.shape == (3, 6, 5)
+    np.testing.assert_allclose(out, reference(img, [0.4, 0.5, 0.6], [0.2, 0.3, 0.4]), atol=1e-5)
+
+def test_default_normalize_and_no_normalize():
+    img = image()
+    np.testing.assert_allclose(compile_transforms([{'type': 'Normalize'}])(img),
+                               reference(img, [0.5] * 3, [0.5] * 3), atol=1e-5)
+    # without 'Normalize' the values stay in [0, 255]
+    np.testing.assert_allclose(compile_transforms([])(img),
+                               img[:, :, ::-1].transpose(2, 0, 1).astype(np.float32), atol=1e-4)
+
+def test_padding_after_normalize_keeps_value():
+    t = compile_transforms([{'type': 'Normalize'}, {'type': 'Padding', 'target_size': [8, 7], 'im_padding_value': 0}])
+    img = image()
+    out = t(img)
+    assert out.shape == (3, 7, 8)
+    np.testing.assert_allclose(out[:, :6, :5], reference(img, [0.5] * 3, [0.5] * 3), atol=1e-5)
+    assert not out[:, 6:, :].any() and not out[:, :, 5:].any()
+
+def test_padding_before_normalize_is_normalised():
+    t = compile_transforms([{'type': 'Padding', 'target_size': 8, 'im_padding_value': 127.5}, {'type': 'Normalize'}])
+    out = t(image())
+    assert out.shape == (3, 8, 8)
+    np.testing.assert_allclose(out[:, 6:, :], 0, atol=1e-6)
+
+def test_padding_smaller_than_image_fails():
+    t = compile_transforms([{'type': 'Padding', 'target_size': 4}])
+    with pytest.raises(ValueError):
+        t(image())
+
+def test_resizes():
+    img = image(40, 20)
+    assert compile_transforms([{'type': 'Resize', 'target_size': [16, 12]}])(img).shape == (3, 12, 16)
+    assert compile_transforms([{'type': 'ResizeByLong', 'long_size': 20}])(img).shape == (3, 20, 10)
+    assert compile_transforms([{'type': 'ResizeByShort', 'short_size': 10}])(img).shape == (3, 20, 10)
+
+def test_unsupported_transforms_are_left_to_paddleseg():
+    assert compile_transforms([{'type': 'RandomHorizontalFlip'}]) is None
+    assert compile_transforms([{'type': 'Resize', 'keep_ratio': True}]) is None
+    assert compile_transforms([{'type': 'Padding', 'target_size': 8}, {'type': 'Resize'}]) is None
+    assert compile_transforms([{'type': 'Normalize'}, {'type': 'Normalize'}]) is None
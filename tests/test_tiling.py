@@ -0,0 +1,73 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of splitting images into tiles and stitching the results in 'tiling'.
+
+import numpy as np
+import pytest
+
+from batching import Sample
+from tiling import Tiler, check_overlap, tile_positions
+
+def run_tiles(tiler, samples, model):
+    """Push 'samples' through 'tiler', running 'model' on each tile"""
+    out = {}
+    for tile in tiler.split(samples):
+        labels, keys = tiler.merge([model(tile)], [tile.key])
+        out.update(zip(keys, labels))
+    return out
+
+def test_tile_positions_cover_axis():
+    assert tile_positions(100, 40, 30) == [0, 30, 60]
+    assert tile_positions(90, 40, 30) == [0, 30, 50]
+    assert tile_positions(30, 40, 30) == [0]
+
+def test_overlap_must_be_less_than_half_a_tile():
+    check_overlap(128, 63)
+    with pytest.raises(ValueError):
+        check_overlap(128, 64)
+    with pytest.raises(ValueError):
+        Tiler(64, 64)
+    with pytest.raises(ValueError):
+        Tiler(64, -1)
+
+def test_stitches_label_maps():
+    rng = np.random.default_rng(0)
+    truth = rng.integers(0, 5, size=(70, 90)).astype(np.uint8)
+    img = Sample('a', truth[None].astype(np.float32))
+    # a model which "predicts" the labels stored in the image
+    model = lambda tile: tile.data[0].astype(np.uint8)
+    out = run_tiles(Tiler(32, 8), [img], model)
+    assert out['a'].dtype == np.uint8
+    np.testing.assert_array_equal(out['a'], truth)
+
+def test_stitches_logits():
+    rng = np.random.default_rng(1)
+    logits = rng.normal(size=(4, 50, 45)).astype(np.float32)
+    img = Sample('a', logits)
+    out = run_tiles(Tiler(20, 6), [img], lambda tile: tile.data)
+    np.testing.assert_array_equal(out['a'], np.argmax(logits, axis=0))
+
+def test_label_type_follows_number_of_classes():
+    img = Sample('a', np.zeros((1, 10, 10), dtype=np.float32))
+    out = run_tiles(Tiler(8, 2, num_classes=300), [img], lambda tile: tile.data[0].astype(np.int32))
+    assert out['a'].dtype == np.int32
+    assert out['a'].shape == (10, 10)
+
+def test_images_complete_independently():
+    imgs = [Sample(i, np.full((1, 12 * (i + 1), 10), i, dtype=np.float32)) for i in range(3)]
+    out = run_tiles(Tiler(8, 2), imgs, lambda tile: tile.data[0].astype(np.uint8))
+    assert sorted(out) == [0, 1, 2]
+    for i in range(3):
+        assert out[i].shape == (12 * (i + 1), 10) and (out[i] == i).all()
@@ -0,0 +1,143 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sliding-window inference: splits large images into overlapping tiles and
+# blends the per-tile results back into a full resolution label map.
+
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from batching import Sample
+
+Window = Tuple[int, int, int, int] # (top, left, bottom, right)
+
+def tile_positions(size: int, tile: int, stride: int) -> List[int]:
+    """Return the start offsets of tiles along one axis of length 'size'.
+    The last tile is aligned with the end of the axis."""
+    if size <= tile:
+        return [0]
+    positions = list(range(0, size - tile, stride))
+    positions.append(size - tile)
+    return positions
+
+def tile_windows(height: int, width: int, tile: int, stride: int) -> List[Window]:
+    return [(y, x, min(y + tile, height), min(x + tile, width))
+            for y in tile_positions(height, tile, stride)
+            for x in tile_positions(width, tile, stride)]
+
+def check_overlap(tile_size: int, overlap: int):
+    """Raise a ValueError unless tiles of 'tile_size' can overlap by 'overlap'
+    pixels. A tile may at most overlap half of its neighbour, as the number
+    of tiles grows quadratically as the stride shrinks."""
+    if tile_size <= 0:
+        raise ValueError(f"'tile-size' must be positive, not {tile_size}")
+    if overlap < 0 or 2 * overlap >= tile_size:
+        raise ValueError(f"'tile-overlap' ({overlap}) must be at least 0 and less than half of 'tile-size' ({tile_size})")
+
+def blend_weights(height: int, width: int, overlap: int) -> np.ndarray:
+    """Weights for a tile of 'height' x 'width' which ramp up linearly over
+    the first and last 'overlap' pixels, so that overlapping tiles fade
+    into each other instead of producing seams."""
+    def ramp(n):
+        d = np.minimum(np.arange(n), np.arange(n)[::-1]) + 1
+        return np.minimum(d / (max(overlap, 0) + 1), 1.0).astype(np.float32)
+    return np.outer(ramp(height), ramp(width))
+
+class Stitcher:
+    """Accumulates the tile results of a single image into a label map.
+
+    For every pixel the label of the tile with the highest score wins. For
+    label maps (HW), as produced by models exported with argmax, the score
+    is the tile's blend weight at that pixel. For logits (CHW) it is the
+    blend weight times the confidence (max softmax probability) of the
+    tile's prediction, so that overlapping tiles still fade into each other.
+    Besides the labels only one float32 score per pixel is kept, however
+    many classes the model has.
+    """
+    def __init__(self, height: int, width: int, tiles: int, overlap: int, label_dtype=np.uint8):
+        self.height = height
+        self.width = width
+        self.remaining = tiles
+        self.overlap = overlap
+        self.labels = np.zeros((height, width), dtype=label_dtype)
+        self.best = np.zeros((height, width), dtype=np.float32)
+
+    def add(self, window: Window, result: np.ndarray):
+        top, left, bottom, right = window
+        score = blend_weights(bottom - top, right - left, self.overlap)
+        if result.ndim == 3:
+            top_score = result.max(axis=0)
+            # max softmax probability, 1 / sum(exp(logits - max))
+            confidence = 1.0 / np.exp(result - top_score).sum(axis=0)
+            score *= confidence
+            result = np.argmax(result, axis=0)
+        best = self.best[top:bottom, left:right]
+        mask = score > best
+        best[mask] = score[mask]
+        self.labels[top:bottom, left:right][mask] = result[mask]
+        self.remaining -= 1
+
+    @property
+    def done(self) -> bool:
+        return self.remaining <= 0
+
+    def result(self) -> np.ndarray:
+        return self.labels
+
+class Tiler:
+    """Splits a stream of preprocessed images into tiles and reassembles the
+    per-tile results into full resolution label maps.
+
+    Tiles of all images share one stream, so a batch may contain tiles of
+    several images. Peak memory of the inference itself only depends on
+    'tile_size' and the batch size, not on the size of the input images,
+    and stitching needs 5 bytes per pixel of an image in flight (see
+    'Stitcher'), not one float per class.
+
+    The preprocessed images themselves are still held at full resolution
+    until all of their tiles have been batched.
+
+    Label maps are uint8 for models with up to 256 classes ('num_classes').
+    """
+    def __init__(self, tile_size: int, overlap: int, num_classes: int = 256):
+        check_overlap(tile_size, overlap)
+        self.tile_size = tile_size
+        self.label_dtype = np.uint8 if num_classes <= 256 else np.int32
+        self.overlap = overlap
+        self.stride = tile_size - self.overlap
+        self.stitchers: Dict[Any, Stitcher] = {}
+
+    def split(self, samples: Iterable[Sample]) -> Iterator[Sample]:
+        for s in samples:
+            _, h, w = s.data.shape
+            windows = tile_windows(h, w, self.tile_size, self.stride)
+            self.stitchers[s.key] = Stitcher(h, w, len(windows), self.overlap, self.label_dtype)
+            for win in windows:
+                top, left, bottom, right = win
+                yield Sample((s.key, win), s.data[:, top:bottom, left:right])
+
+    def merge(self, results: List[np.ndarray], keys: List[Any]) -> Tuple[List[np.ndarray], List[Any]]:
+        """Add a batch of tile results and return the label maps (and keys)
+        of all images which are now complete."""
+        labels = []
+        done = []
+        for result, (key, win) in zip(results, keys):
+            stitcher = self.stitchers[key]
+            stitcher.add(win, result)
+            if stitcher.done:
+                labels.append(stitcher.result())
+                done.append(key)
+                del self.stitchers[key]
+        return labels, done
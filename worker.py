@@ -0,0 +1,168 @@
+# Copyright (c) 2023 CSIRO. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Resident worker which keeps initialised predictors warm across jobs.
+#
+# The worker listens on a local (unix) socket for jobs. Each job is a single
+# line of JSON holding the same parameters as the 'infer_service' (using the
+# parameter names of 'SERVICE'), with local file names for 'model' and
+# 'images'. For example:
+#
+#   {"model": "/models/segformer.tgz", "images": ["/data/a.jpg", "/data/b.jpg"], "batch-size": 4}
+#
+# The worker replies with one line of JSON per job, '{"status": "ok", ...}' or
+# '{"status": "error", "error": "..."}'. Jobs are executed one at a time in
+# the order they arrive.
+
+from collections import namedtuple
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from ivcap_sdk_service import Service, Parameter, Type, ServiceArgs
+from ivcap_sdk_service import register_service, PythonWorkflow
+
+import infer_service
+from predictor import PredictorPool, rss_bytes
+
+logger = None # set when called by SDK
+
+WORKER = Service(
+    name = "infer-with-paddle-paddle-worker",
+    description = "A resident worker which applies PaddlePaddle models to images submitted over a local socket",
+    parameters = [
+        Parameter(
+            name='socket',
+            type=Type.STRING,
+            description='Path of the unix socket to accept jobs on.',
+            default="/tmp/paddle-seg-worker.sock"),
+        Parameter(
+            name='max-predictors',
+            type=Type.INT,
+            description='Max number of initialised predictors to keep.',
+            default=2),
+        Parameter(
+            name='max-memory',
+            type=Type.INT,
+            description='Evict least recently used predictors while the worker uses more than this many MB '
+            '(-1 for no limit).',
+            default=-1),
+        Parameter(
+            name='model-cache-dir',
+            type=Type.STRING,
+            description="Directory to keep extracted models in, unless a job sets its own 'model-cache-dir'.",
+            default="/tmp/paddle-seg-models"),
+    ],
+    workflow = PythonWorkflow(min_memory="5Gi"),
+)
+
+class LocalArtifact:
+    """Minimal stand-in for an IVCAP artifact backed by a local file"""
+    def __init__(self, path: str, urn: Optional[str] = None):
+        self.path = path
+        self.name = urn or path
+
+    def as_local_file(self) -> str:
+        return self.path
+
+    def __repr__(self):
+        return f"LocalArtifact({self.name})"
+
+def default_value(p: Parameter) -> Any:
+    """The default of 'p' as the type the service expects (the SDK keeps defaults as strings)"""
+    if p.type == Type.BOOL:
+        return str(p.default).lower() == 'true'
+    if p.default is None:
+        return None
+    conv = {Type.INT: int, Type.FLOAT: float}.get(p.type)
+    return conv(p.default) if conv else p.default
+
+def job_args(job: Dict[str, Any], defaults: Dict[str, Any]) -> ServiceArgs:
+    """Turn a job request into the 'args' expected by 'infer_service.service'"""
+    args = {}
+    for p in infer_service.SERVICE.parameters:
+        key = p.name.replace('-', '_')
+        if p.name in job:
+            value = job[p.name]
+        else:
+            value = defaults.get(key, default_value(p))
+        args[key] = value
+    images = job.get('images')
+    if not images or not job.get('model'):
+        raise ValueError("job requires 'model' and 'images'")
+    if isinstance(images, str):
+        images = [images]
+    args['model'] = LocalArtifact(job['model'], job.get('model-urn'))
+    extra = job.get('extra-models') or []
+    args['extra_models'] = [LocalArtifact(p) for p in ([extra] if isinstance(extra, str) else extra)]
+    args['images'] = [LocalArtifact(p) for p in images]
+    ST = namedtuple('ServiceArgs', args.keys())
+    return ST(**args)
+
+class Worker:
+    def __init__(self, args: ServiceArgs):
+        max_rss = args.max_memory * 1024 * 1024 if args.max_memory > 0 else 0
+        self.predictors = PredictorPool(args.max_predictors, max_rss)
+        self.defaults = {'model_cache_dir': args.model_cache_dir}
+        self.lock = threading.Lock()
+
+    def run_job(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            start = time.time()
+            try:
+                args = job_args(job, self.defaults)
+                infer_service.service(args, logger, self.predictors)
+                reply = {"status": "ok", "images": len(args.images)}
+            except Exception as err:
+                logger.exception(err)
+                reply = {"status": "error", "error": str(err)}
+            self.predictors.evict()
+            reply["elapsed"] = time.time() - start
+            reply["predictors"] = len(self.predictors)
+            reply["rss"] = rss_bytes()
+            return reply
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as err:
+                reply = {"status": "error", "error": f"invalid job - {err}"}
+            else:
+                reply = self.server.worker.run_job(job)
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+def serve(args: ServiceArgs, svc_logger: logging):
+    """Accept jobs on 'args.socket' until the process is terminated"""
+    global logger
+    logger = svc_logger
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with socketserver.ThreadingUnixStreamServer(args.socket, JobHandler) as server:
+        server.worker = Worker(args)
+        logger.info(f"Waiting for jobs on '{args.socket}'")
+        server.serve_forever()
+
+if __name__ == '__main__':
+    register_service(WORKER, serve)